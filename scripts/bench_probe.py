@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the per-dataset filesystem checks against the width of the
+probe thread pool (project.probe_threads)
+
+    ./bench_probe.py <config.yaml> [--widths 1 2 4 8 16 32] [--limit N]
+
+The checks are run the uncached way, so every call goes to the
+filesystem: xia_result / dmpl_result without the results scan, and a
+full frame count of each raw dataset directory. Note the first width
+tried also warms the client metadata cache, so repeat it at the end
+(e.g. --widths 1 2 4 8 1) to see how much of the gain is caching.
+"""
+
+import time
+import argparse
+
+from xia2pipe.projbase import ProjectBase
+from xia2pipe.rawindex import count_frames
+
+
+def time_probe(pb, fn, mds, width):
+    pb.probe_threads = width
+    t0 = time.time()
+    pb.probe(fn, mds)
+    return time.time() - t0
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='time filesystem probes vs pool width')
+    parser.add_argument('config', type=str,
+                        help='the configuration yaml file to use')
+    parser.add_argument('--widths', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32],
+                        help='thread pool widths to try')
+    parser.add_argument('--limit', type=int, default=2000,
+                        help='max number of datasets to probe')
+    args = parser.parse_args()
+
+    pb = ProjectBase.load_config(args.config)
+    pb.results_index = None # force real filesystem access
+
+    mds = pb.db.select(['metadata', 'run_id'],
+                       'SARS_COV_2_v2.Diffractions',
+                       {'diffraction' : 'Success'})
+    mds = [ (r['metadata'], r['run_id']) for r in mds ][:args.limit]
+
+    raw_paths = []
+    for md in mds:
+        raw_paths.extend([ (ds.path, ds.ext) for ds in pb.raw_index.lookup(*md) ])
+
+    print('datasets: {}   raw directories: {}'.format(len(mds), len(raw_paths)))
+    print('')
+    print('{:>6s} {:>12s} {:>12s} {:>12s} {:>12s}'
+          ''.format('width', 'xia [s]', 'dmpl [s]', 'frames [s]', 'total [s]'))
+
+    for width in args.widths:
+        t_xia  = time_probe(pb, pb.xia_result, mds, width)
+        t_dmpl = time_probe(pb, pb.dmpl_result, mds, width)
+        t_raw  = time_probe(pb, count_frames, raw_paths, width)
+        print('{:6d} {:12.2f} {:12.2f} {:12.2f} {:12.2f}'
+              ''.format(width, t_xia, t_dmpl, t_raw, t_xia + t_dmpl + t_raw))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
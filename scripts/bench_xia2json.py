@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the selective xia2.json reader against json.load
+
+    ./bench_xia2json.py '<results_dir>/<name>/*/*/*/scale/xia2.json' [--limit N]
+
+For each file both readers are run, their output compared, and the
+wall time and peak Python heap (tracemalloc) of each recorded.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from glob import glob
+from math import isnan
+
+from xia2pipe.xia2json import read_selective, read_full, LayoutError
+
+
+def measure(fn, path):
+    tracemalloc.start()
+    t0 = time.time()
+    result = fn(path)
+    dt = time.time() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, dt, peak
+
+
+def same(a, b):
+    # NaN != NaN, so compare those by hand
+    if isinstance(a, float) and isinstance(b, float) and isnan(a) and isnan(b):
+        return True
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all([ same(a[k], b[k]) for k in a ])
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all([ same(x, y) for x, y in zip(a, b) ])
+    return a == b
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='selective vs full xia2.json parsing')
+    parser.add_argument('pattern', type=str,
+                        help='glob pattern matching xia2.json files')
+    parser.add_argument('--limit', type=int, default=200,
+                        help='max number of files to read')
+    args = parser.parse_args()
+
+    paths = sorted(glob(args.pattern))[:args.limit]
+    if len(paths) == 0:
+        print('no files match: {}'.format(args.pattern))
+        sys.exit(1)
+
+    totals = { 'full' : [0.0, 0], 'selective' : [0.0, 0] }
+    n_mb, n_fallback, n_mismatch = 0.0, 0, 0
+
+    for path in paths:
+        n_mb += os.path.getsize(path) / 1e6
+
+        ref, dt, peak = measure(read_full, path)
+        totals['full'][0] += dt
+        totals['full'][1]  = max(totals['full'][1], peak)
+
+        try:
+            res, dt, peak = measure(read_selective, path)
+        except LayoutError as e:
+            print('fallback needed: {} ({})'.format(path, e))
+            n_fallback += 1
+            continue
+        totals['selective'][0] += dt
+        totals['selective'][1]  = max(totals['selective'][1], peak)
+
+        if not same(ref, res):
+            print('! mismatch: {}'.format(path))
+            n_mismatch += 1
+
+    print('')
+    print('files: {}   total size: {:.1f} MB'.format(len(paths), n_mb))
+    print('fallbacks: {}   mismatches: {}'.format(n_fallback, n_mismatch))
+    print('')
+    print('{:>10s} {:>12s} {:>16s}'.format('reader', 'time [s]', 'peak heap [MB]'))
+    for name, (t, peak) in totals.items():
+        print('{:>10s} {:12.2f} {:16.1f}'.format(name, t, peak / 1e6))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
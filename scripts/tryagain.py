@@ -16,6 +16,7 @@ def fetch_to_try_again(config_file):
 
     dd = DimplingDaemon.load_config(config_file)
 
+    dd.scan_results()
     to_run = set(dd.fetch_reduction_successes(in_db=True))
     print('completed:                       {}'.format(len(to_run)))
 
@@ -24,9 +25,10 @@ def fetch_to_try_again(config_file):
     successes = 0
     failures  = 0
     for md in to_run:
-        if dd.dmpl_result(*md) == 'finished':
+        result = dd.dmpl_result(*md)
+        if result == 'finished':
             successes += 1
-        elif dd.dmpl_result(*md) == 'procfail':
+        elif result == 'procfail':
             to_try_again.append(md)
             failures  += 1
 
@@ -13,6 +13,7 @@ setup(name='xia2pipe',
               'x2p.reduce=xia2pipe.xiadaemon:script',
               'x2p.refine=xia2pipe.dmpldaemon:script',
               'x2p.sync=xia2pipe.dbdaemon:script',
+              'x2p.recheck=xia2pipe.xiadaemon:recheck_script',
           ],
       },
       zip_safe=False)
@@ -0,0 +1,139 @@
+import time
+
+import pytest
+from mysql import connector
+
+from xia2pipe.connector import SQL, _chunks
+
+
+def test_chunks_full_and_padded_remainder():
+    chunks = _chunks(list(range(1001)), 1000)
+    assert [ len(c) for c in chunks ] == [1000, 1]
+    assert chunks[0] == list(range(1000))
+    assert chunks[1] == [1000]
+
+    chunks = _chunks(list(range(5)), 1000)
+    assert chunks == [[0, 1, 2, 3, 4, 4, 4, 4]]
+
+
+def test_chunks_drops_duplicates():
+    assert _chunks([3, 1, 3, 2, 1], 2) == [[3, 1], [2]]
+
+
+def test_select_null_conditions():
+    sql = SQL({})
+    queries = sql._select_queries(['crystal_id', 'run_id'], 'Diffractions',
+                                  {'metadata' : None, 'comment' : 'NULL',
+                                   'run_id' : 7})
+    assert queries == [("SELECT crystal_id, run_id FROM Diffractions "
+                        "WHERE metadata IS NULL AND comment IS NULL AND run_id=%s",
+                        [7])]
+
+
+def test_select_no_condition():
+    sql = SQL({})
+    assert sql._select_queries('*', ['Crystals', 'Diffractions']) == \
+           [("SELECT * FROM Crystals, Diffractions", [])]
+
+
+def test_select_empty_in_list():
+    sql = SQL({})
+    assert sql._select_queries('*', 'Crystals', {'crystal_id' : []}) == []
+
+
+def test_select_in_list_chunked():
+    sql = SQL({})
+    ids = list(range(2500))
+    queries = sql._select_queries('*', 'Crystals',
+                                  {'crystal_id' : ids, 'diffraction' : 'Success'})
+
+    assert len(queries) == 3
+    bound = []
+    for query, params in queries:
+        n = len(params) - 1
+        assert n <= sql.max_in_params
+        assert query == ("SELECT * FROM Crystals WHERE crystal_id IN ({}) "
+                         "AND diffraction=%s".format(", ".join(["%s"] * n)))
+        assert params[-1] == 'Success'
+        bound.extend(params[:-1])
+
+    assert [ len(p) - 1 for _, p in queries ] == [1000, 1000, 512]
+    assert set(bound) == set(ids)
+
+
+def test_select_several_in_lists():
+    sql = SQL({})
+    sql.max_in_params = 2
+    queries = sql._select_queries('*', 'Diffractions',
+                                  {'metadata' : ['a', 'b', 'c'],
+                                   'run_id'   : {1, 2}})
+
+    assert sorted(queries) == \
+        [ ("SELECT * FROM Diffractions "
+           "WHERE metadata IN (%s) AND run_id IN (%s, %s)", ['c', 1, 2]),
+          ("SELECT * FROM Diffractions "
+           "WHERE metadata IN (%s, %s) AND run_id IN (%s, %s)", ['a', 'b', 1, 2]) ]
+
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def executemany(self, query, values):
+        if any([ 'bad' in v for v in values ]):
+            raise connector.Error('bad row')
+        self.connection.pending.extend(values)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.rows    = []
+        self.pending = []
+
+    def start_transaction(self):
+        self.pending = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.rows.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_sql():
+    sql = SQL({})
+    sql.connection = FakeConnection()
+    sql._thread.last_used = time.time()
+    return sql
+
+
+def test_insert_many(fake_sql):
+    rows = [ {'metadata' : 'l{}'.format(i), 'run_id' : i} for i in range(5) ]
+    rows.append( {'metadata' : 'x', 'comment' : 'NULL'} )
+
+    assert fake_sql.insert_many('Diffractions', rows, chunk_size=2) == 6
+    assert fake_sql.connection.rows == \
+           [ ('l{}'.format(i), i) for i in range(5) ] + [ ('x', None) ]
+
+
+def test_insert_many_row_by_row_fallback(fake_sql):
+    rows = [ {'metadata' : m} for m in ['a', 'b', 'bad', 'c', 'd'] ]
+
+    assert fake_sql.insert_many('Diffractions', rows, chunk_size=4) == 4
+    assert fake_sql.connection.rows == [ ('a',), ('b',), ('c',), ('d',) ]
@@ -0,0 +1,51 @@
+from xia2pipe.slurmjobs import (Job, array_tasks, match_jobs, write_manifest,
+                                elapsed_to_seconds, memory_to_mb)
+
+
+def test_array_tasks():
+    assert array_tasks('1234_7') == ('1234', [7])
+    assert array_tasks('1234_[0-3,8%10]') == ('1234', [0, 1, 2, 3, 8])
+    assert array_tasks('1234_[5]') == ('1234', [5])
+    assert array_tasks('1234') == ('1234', None)
+
+
+def test_elapsed_and_memory():
+    assert elapsed_to_seconds('1-02:03:04') == 93784
+    assert elapsed_to_seconds('05:06') == 306
+    assert elapsed_to_seconds('UNLIMITED') == 0
+    assert memory_to_mb('2048K') == 2.0
+    assert memory_to_mb('1.5G') == 1536.0
+    assert memory_to_mb('6Gn') == 6144.0
+    assert memory_to_mb('') == 0.0
+
+
+def job(job_id, name):
+    return Job(job_id, name, 'RUNNING', 0, 'node1')
+
+
+def test_match_jobs_by_name():
+    jobs = [ job('1', 'DIALS-dmpl_l6p17-10'),
+             job('2', 'DIALS-dmpl_l6p17-1001'),
+             job('3', 'DIALS_l6p17-10'),
+             job('4', 'DIALS-dmpl_array') ]
+
+    matched = list(match_jobs(jobs, 'DIALS-dmpl_'))
+    assert matched == [ (('l6p17', 10), jobs[0]), (('l6p17', 1001), jobs[1]) ]
+
+
+def test_match_jobs_array_tasks(tmpdir):
+    rows = [ {'metadata' : 'l6p17', 'run' : r} for r in [1, 2, 3] ]
+    write_manifest(str(tmpdir.join('55.tsv')), rows)
+
+    jobs = [ job('55_[1-2]', 'DIALS-dmpl_array'),
+             job('55_0', 'DIALS-dmpl_array'),
+             job('55_[9]', 'DIALS-dmpl_array'),
+             job('66_0', 'DIALS-dmpl_array') ]
+
+    matched = list(match_jobs(jobs, 'DIALS-dmpl_', manifest_dir=str(tmpdir)))
+    assert matched == [ (('l6p17', 2), jobs[0]),
+                        (('l6p17', 3), jobs[0]),
+                        (('l6p17', 1), jobs[1]) ]
+
+    # without manifest_dir, array jobs are not matched
+    assert list(match_jobs(jobs, 'DIALS-dmpl_')) == []
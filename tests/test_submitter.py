@@ -0,0 +1,88 @@
+import os
+import stat
+
+import pytest
+
+from xia2pipe.submitter import Submitter
+
+
+FAKE_SBATCH = """#!/bin/sh
+# fake sbatch: fails for scripts containing FAIL, else prints the
+# script name as the job id; the command lines are logged
+for last; do true; done
+echo "$@" >> {log}
+if grep -q FAIL "$last"; then
+    echo "sbatch: error: invalid script" >&2
+    exit 1
+fi
+echo "$(basename $last);cluster"
+"""
+
+
+@pytest.fixture
+def sbatch(tmpdir):
+    path = str(tmpdir.join('sbatch'))
+    with open(path, 'w') as f:
+        f.write(FAKE_SBATCH.format(log=tmpdir.join('sbatch.log')))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def scripts(tmpdir, n, fail=()):
+    ret = []
+    for i in range(n):
+        path = str(tmpdir.join('job{}.sh'.format(i)))
+        with open(path, 'w') as f:
+            f.write('FAIL\n' if i in fail else '#!/bin/bash\n')
+        ret.append( (i, path) )
+    return ret
+
+
+def test_submit_all(tmpdir, sbatch):
+    todo = scripts(tmpdir, 6)
+    result = Submitter(concurrency=3, sbatch=sbatch).submit(todo)
+
+    assert result.submitted == { i : 'job{}.sh'.format(i) for i in range(6) }
+    assert result.failed == {}
+    assert result.held == []
+    assert not any([ os.path.exists(p) for _, p in todo ])
+
+
+def test_max_pending(tmpdir, sbatch):
+    todo = scripts(tmpdir, 8)
+    submitter = Submitter(concurrency=4, max_pending=5, pending=2, sbatch=sbatch)
+    result = submitter.submit(todo)
+
+    assert len(result.submitted) == 3
+    assert sorted(result.held + list(result.submitted)) == list(range(8))
+    assert submitter.pending == 5
+    assert not any([ os.path.exists(p) for _, p in todo ])
+
+
+def test_failed_frees_its_slot(tmpdir, sbatch):
+    todo = scripts(tmpdir, 8, fail=[0])
+    result = Submitter(concurrency=4, max_pending=5, sbatch=sbatch).submit(todo)
+
+    assert list(result.failed) == [0]
+    assert 'invalid script' in result.failed[0]
+    assert len(result.submitted) == 5
+    assert len(result.held) == 2
+    assert not any([ os.path.exists(p) for _, p in todo ])
+
+
+def test_extra_args(tmpdir, sbatch):
+    todo = scripts(tmpdir, 2)
+    Submitter(sbatch=sbatch).submit(todo, extra_args={1 : ['--dependency=afterok:7']})
+
+    log = tmpdir.join('sbatch.log').read().splitlines()
+    assert sorted(log) == sorted([ '--parsable {}'.format(todo[0][1]),
+                                   '--parsable --dependency=afterok:7 {}'.format(todo[1][1]) ])
+
+
+def test_no_sbatch(tmpdir):
+    todo = scripts(tmpdir, 2)
+    result = Submitter(sbatch=str(tmpdir.join('missing'))).submit(todo)
+
+    assert result.submitted == {}
+    assert sorted(result.failed) == [0, 1]
+    assert not any([ os.path.exists(p) for _, p in todo ])
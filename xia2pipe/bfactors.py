@@ -0,0 +1,159 @@
+"""
+Native PDB / mmCIF readers for model B-factors
+"""
+
+import re
+import numpy as np
+
+
+WATER_NAMES = [b'HOH', b'WAT', b'DOD', b'H2O']
+
+_MEAN_B_PDB = re.compile(r'MEAN B VALUE\s+\(OVERALL, A\*\*2\) :\s+(\d+.\d+)')
+_MEAN_B_CIF = re.compile(r'^_refine\.B_iso_mean\s+(\d+.\d+)')
+
+
+def _is_cif(path):
+    return path.endswith('.cif') or path.endswith('.mmcif')
+
+
+def header_mean_b(model_path):
+    """
+    Return the overall mean B reported in the model header (PDB REMARK 3
+    or mmCIF _refine.B_iso_mean), or 'NULL' if there is none. Reading
+    stops at the first atom record.
+    """
+
+    ptn = _MEAN_B_CIF if _is_cif(model_path) else _MEAN_B_PDB
+
+    with open(model_path, 'r') as f:
+        for line in f:
+            if line.startswith('ATOM') or line.startswith('HETATM'):
+                break
+            if line.startswith('_atom_site.'):
+                break
+            g = ptn.search(line)
+            if g:
+                return float(g.groups()[0])
+
+    return 'NULL'
+
+
+def _pdb_columns(model_path):
+    """
+    Return (record, resname, chain, b) arrays for all ATOM/HETATM lines
+    """
+
+    lines = []
+    with open(model_path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'ATOM') or line.startswith(b'HETATM'):
+                lines.append(line.rstrip(b'\r\n').ljust(80)[:80])
+            elif line.startswith(b'ENDMDL'):
+                break # first model only
+
+    if len(lines) == 0:
+        raise IOError('no atoms in: {}'.format(model_path))
+
+    # one (n_atoms, 80) character matrix, then slice the fixed columns
+    chars = np.array(lines, dtype='S80').view('S1').reshape(len(lines), 80)
+
+    def field(start, stop):
+        return chars[:, start:stop].copy().view('S{}'.format(stop-start)).ravel()
+
+    record  = field(0, 6)
+    resname = np.char.strip(field(17, 20))
+    chain   = np.char.strip(field(21, 22))
+    b       = field(60, 66).astype(float)
+
+    return record, resname, chain, b
+
+
+def _cif_columns(model_path):
+    """
+    Return (record, resname, chain, b) arrays from the _atom_site loop
+    """
+
+    names = []
+    rows  = []
+
+    with open(model_path, 'rb') as f:
+        in_loop = False
+        for line in f:
+            if line.startswith(b'_atom_site.'):
+                names.append(line.strip().split(b'.', 1)[1].decode())
+                in_loop = True
+            elif in_loop:
+                if line.startswith(b'ATOM') or line.startswith(b'HETATM'):
+                    rows.append(line.split())
+                elif rows and (line.startswith(b'#') or line.startswith(b'loop_')
+                               or line.startswith(b'_')):
+                    break
+
+    if len(rows) == 0:
+        raise IOError('no atoms in: {}'.format(model_path))
+
+    cols = np.array([ r[:len(names)] for r in rows if len(r) >= len(names) ])
+
+    def column(*keys):
+        for k in keys:
+            if k in names:
+                return cols[:, names.index(k)]
+        raise IOError('no {} column in: {}'.format(keys[0], model_path))
+
+    record  = column('group_PDB')
+    resname = column('label_comp_id', 'auth_comp_id')
+    chain   = column('auth_asym_id', 'label_asym_id')
+    b       = column('B_iso_or_equiv').astype(float)
+
+    # first model only
+    if 'pdbx_PDB_model_num' in names:
+        model = column('pdbx_PDB_model_num')
+        first = (model == model[0])
+        record, resname, chain, b = record[first], resname[first], chain[first], b[first]
+
+    return record, resname, chain, b
+
+
+def _summary(b):
+    if len(b) == 0:
+        return {'n' : 0, 'mean' : None, 'min' : None, 'max' : None}
+    return {'n' : int(len(b)), 'mean' : float(b.mean()),
+            'min' : float(b.min()), 'max' : float(b.max())}
+
+
+def b_factor_statistics(model_path):
+    """
+    B-factor statistics of a PDB or mmCIF model, the native equivalent
+    of phenix.b_factor_statistics:
+
+        {'all' : {n, mean, min, max},
+         'protein' : {...}, 'ligand' : {...}, 'water' : {...},
+         'chains' : {chain_id : {...}}}
+
+    protein = ATOM records, water = HOH/WAT/DOD, ligand = other HETATMs
+    """
+
+    if _is_cif(model_path):
+        record, resname, chain, b = _cif_columns(model_path)
+    else:
+        record, resname, chain, b = _pdb_columns(model_path)
+
+    record  = np.char.strip(record.astype('S6'))
+    resname = resname.astype('S3')
+    chain   = chain.astype('S4')
+
+    water   = np.isin(resname, WATER_NAMES)
+    protein = (record == b'ATOM') & ~water
+    ligand  = ~protein & ~water
+
+    stats = {
+             'all'     : _summary(b),
+             'protein' : _summary(b[protein]),
+             'ligand'  : _summary(b[ligand]),
+             'water'   : _summary(b[water]),
+             'chains'  : { c.decode() : _summary(b[chain == c])
+                           for c in np.unique(chain) },
+            }
+
+    return stats
+
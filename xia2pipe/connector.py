@@ -8,8 +8,16 @@ __date__ = "3/2020"
 __status__ = "beta"
 __license__ = "GPL v3+"
 
+import time
+import weakref
+import threading
+import itertools
+
+from collections import namedtuple, OrderedDict
+
 from datetime import datetime
 from mysql import connector
+from mysql.connector import pooling
 from numpy import ndarray
 
 
@@ -24,15 +32,149 @@ def get_single(query, crystal_id, run, field_name):
     return query[0][field_name]
 
 
+def _bindable(value):
+    """
+    Map the "NULL" string used by `insert` to a bound NULL
+    """
+    if type(value) == str and value == "NULL":
+        return None
+    return value
+
+
+def _placeholders(n):
+    return ", ".join(["%s"] * n)
+
+
+def _chunks(values, max_size):
+    """
+    Split values into full chunks of max_size and one remainder. The
+    remainder is padded with a repeated value to the next power of two
+    (at most max_size), so that only a few distinct statements are ever
+    prepared. Duplicate values are dropped first, so that no row can
+    match in two chunks.
+    """
+
+    values = list(OrderedDict.fromkeys(values))
+
+    n_full = len(values) // max_size
+    chunks = [ values[i*max_size:(i+1)*max_size] for i in range(n_full) ]
+
+    rest = values[n_full*max_size:]
+    if len(rest) > 0:
+        size = 1
+        while size < len(rest):
+            size *= 2
+        size = min(size, max_size)
+        chunks.append( rest + [rest[-1]] * (size - len(rest)) )
+
+    return chunks
+
+
+class _ThreadConnection(object):
+    """ one thread's connection and prepared statements
+
+    the connection is closed (in pooled mode: returned to the pool) when
+    the thread ends and its thread-local state is collected
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.statements = OrderedDict()
+        self.last_used  = 0.0
+        return
+
+
+    def close(self):
+        connection, self.connection = self.connection, None
+        self.statements = OrderedDict()
+        if connection is not None:
+            try:
+                connection.close()
+            except connector.Error:
+                pass
+        return
+
+
+    def detach(self):
+        self.connection = None
+        self.statements = OrderedDict()
+        return
+
+
+    def __del__(self):
+        self.close()
+        return
+
+
 class SQL(object):
 
+    # max number of values bound in one `key IN (...)` clause
+    max_in_params = 1000
+
+    # max number of prepared statements kept open per connection
+    max_statements = 64
+
     def __init__(self, config):
+        """
+        config holds the mysql.connector.connect arguments, plus the
+        optional keys (which are not passed on to mysql):
+
+            pool_size     : if set, hand out one pooled connection per thread,
+                            returned to the pool when the thread ends
+            idle_ping     : only ping the server if a connection has been
+                            idle for longer than this [s], default 30
+            max_reconnect : connection attempts, with exponential backoff
+        """
+
+        self.config = dict(config)
+
+        self.pool_size     = self.config.pop('pool_size', None)
+        self.idle_ping     = self.config.pop('idle_ping', 30.0)
+        self.max_reconnect = self.config.pop('max_reconnect', 5)
+
+        self._pool      = None
+        self._pool_lock = threading.Lock()
+
+        # the connection and its prepared statements are per-thread
+        self._local   = threading.local()
+        self._threads = weakref.WeakSet()
 
-        self.config = config
-        self.connection = None
         return
 
 
+    @property
+    def _thread(self):
+        thread = getattr(self._local, 'thread', None)
+        if thread is None:
+            thread = _ThreadConnection()
+            self._local.thread = thread
+            with self._pool_lock:
+                self._threads.add(thread)
+        return thread
+
+
+    @property
+    def connection(self):
+        return self._thread.connection
+
+
+    @connection.setter
+    def connection(self, value):
+        self._thread.connection = value
+
+
+    @property
+    def _statements(self):
+        # prepared statements for the current connection, keyed by query,
+        # least recently used first
+        return self._thread.statements
+
+
+    @_statements.setter
+    def _statements(self, value):
+        self._thread.statements = value
+
+
     def __enter__(self):
 
         # connect to the database
@@ -42,8 +184,48 @@ class SQL(object):
 
 
     def __exit__(self, exception_type, exception_value, traceback):
-        if self.is_connected():
-            self.connection.disconnect()
+        self.release()
+        return
+
+
+    def release(self):
+        """ close this thread's connection, in pooled mode this returns
+        it to the pool
+        """
+        self._thread.close()
+        return
+
+
+    def close(self):
+        """ close the connections of all threads and the idle pooled
+        ones, e.g. before forking, so that no socket is shared with the
+        children
+        """
+        with self._pool_lock:
+            threads, self._threads = list(self._threads), weakref.WeakSet()
+            pool, self._pool = self._pool, None
+
+        for thread in threads:
+            thread.close()
+
+        if pool is not None:
+            pool._remove_connections()
+
+        self._local = threading.local()
+
+        return
+
+
+    def reset(self):
+        """ forget all connections without closing them, for use in a
+        forked child: the sockets belong to the parent process
+        """
+        for thread in list(self._threads):
+            thread.detach()
+        self._pool      = None
+        self._pool_lock = threading.Lock()
+        self._local     = threading.local()
+        self._threads   = weakref.WeakSet()
         return
 
 
@@ -60,23 +242,52 @@ class SQL(object):
         return False
 
 
-    def connect(self, verbose=False):
-        """ connect to the database
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = pooling.MySQLConnectionPool(
+                                 pool_name='x2p_{}'.format(id(self)),
+                                 pool_size=self.pool_size,
+                                 **self.config)
+        return self._pool
+
+
+    def _new_connection(self):
+        """ a new connection, from the pool if pooling is on
+        retries up to `max_reconnect` times with exponential backoff
         """
 
-        try:
-            self.connection = connector.connect(**self.config)
+        for attempt in range(self.max_reconnect):
+            try:
+                if self.pool_size:
+                    return self._get_pool().get_connection()
+                else:
+                    return connector.connect(**self.config)
 
-        except connector.Error as err:
+            except connector.Error as err:
 
-            if err.errno == connector.errorcode.ER_ACCESS_DENIED_ERROR:
-                raise ValueError("Wrong user or password...")
+                if err.errno == connector.errorcode.ER_ACCESS_DENIED_ERROR:
+                    raise ValueError("Wrong user or password...")
 
-            elif err.errno == connector.errorcode.ER_BAD_DB_ERROR:
-                raise ValueError("Database does not exist...")
+                elif err.errno == connector.errorcode.ER_BAD_DB_ERROR:
+                    raise ValueError("Database does not exist...")
 
-            else:
-                raise ValueError(err)
+                elif attempt == self.max_reconnect - 1:
+                    raise ValueError(err)
+
+                else:
+                    time.sleep(min(2 ** attempt, 30))
+
+
+    def connect(self, verbose=False):
+        """ connect to the database
+        a stale connection of this thread is closed (returned to the
+        pool) first, and its prepared statements dropped
+        """
+
+        self._thread.close()
+        self.connection = self._new_connection()
+        self._thread.last_used = time.time()
 
         # be verbose
         if verbose:
@@ -92,20 +303,39 @@ class SQL(object):
         return
 
 
-    def execute(self, query, dictionary=True, verbose=False):
+    def _ensure_connected(self):
+        """ connect if needed, but only ping the server when the
+        connection has been idle for more than `idle_ping` seconds
+        """
+
+        now = time.time()
+
+        if self.connection is None:
+            self.connect()
+        elif now - self._thread.last_used > self.idle_ping:
+            if not self.connection.is_connected():
+                self.connect()
+
+        self._thread.last_used = now
+
+        return
+
+
+    def execute(self, query, params=None, dictionary=True, verbose=False):
         """ execute a query
         by default the query returns a dictionary
+        params are bound to %s placeholders in the query
         """
 
         if verbose:
-            print("{}: MySQL: {}".format(datetime.now().time(), query))
+            print("{}: MySQL: {} {}".format(datetime.now().time(), query,
+                                            params if params else ""))
 
         # auto-connect
-        if not self.is_connected():
-            self.connect()
+        self._ensure_connected()
 
         cursor = self.connection.cursor(dictionary=dictionary)
-        cursor.execute(query)
+        cursor.execute(query, params)
 
         return cursor
 
@@ -164,6 +394,78 @@ class SQL(object):
             key [string or array] = 'crystal_id', ['crystal_id', 'crystal_id'] or '*'
             table [string or array] = 'Crystals' or ['Crystals', 'Repeated_diffraction']
             condition [dictionary] = {'metadata': "p10l2"}
+
+        condition values that are lists, tuples, sets or arrays become
+        `key IN (...)`, e.g. {'crystal_id': [1, 2, 3]}; long lists (any
+        number of them) are split into chunks of at most `max_in_params`
+        and the results merged. All values are bound as parameters of a
+        prepared statement that is re-used across calls.
+        """
+
+        result = []
+        for query, params in self._select_queries(key, table, condition):
+            result.extend(self._fetch_prepared(query, params, verbose=verbose))
+
+        return result
+
+
+    def select_iter(self, key, table, condition=None, row_type="dict",
+                    chunk_size=1000, verbose=False):
+        """ like `select`, but a generator that streams rows from an
+        unbuffered server-side cursor, `chunk_size` rows at a time
+
+        row_type is one of "dict", "tuple" or "namedtuple"
+
+        the stream runs on its own connection (from the pool, if
+        pooling is on), so other queries can be run while consuming it
+        """
+
+        if row_type not in ["dict", "tuple", "namedtuple"]:
+            raise ValueError("unknown row_type {}...".format(row_type))
+
+        queries = self._select_queries(key, table, condition)
+        if len(queries) == 0:
+            return
+
+        connection = self._new_connection()
+
+        try:
+            cursor = connection.cursor(prepared=True)
+
+            for query, params in queries:
+
+                if verbose:
+                    print("{}: MySQL: {} {}".format(datetime.now().time(), query, params))
+
+                cursor.execute(query, tuple(params))
+                columns = cursor.column_names
+
+                if row_type == "namedtuple":
+                    Row = namedtuple("Row", columns, rename=True)
+
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        if row_type == "dict":
+                            yield dict(zip(columns, row))
+                        elif row_type == "namedtuple":
+                            yield Row(*row)
+                        else:
+                            yield tuple(row)
+
+            cursor.close()
+
+        finally:
+            connection.close()
+
+        return
+
+
+    def _select_queries(self, key, table, condition=None):
+        """ build the (query, params) pairs needed for a select,
+        more than one if an IN (...) list has to be chunked
         """
 
         # key and table are arrays
@@ -189,32 +491,89 @@ class SQL(object):
         # execute the query
         query = "SELECT {} FROM {}".format(key, table)
 
-        # condition
-        if condition:
-            bcondition = ""
+        # condition, as a list of (clause, params)
+        # IN (...) clauses have params=None and are chunked below
+        clauses   = []
+        in_values = []
 
+        if condition:
             for ki, vi in condition.items():
-                if type(vi) == str and vi != "NULL":
-                    bcondition += '{}="{}" AND '.format(ki, vi)
 
+                if type(vi) in arraylike + [set, frozenset]:
+                    vi = list(vi)
+                    if len(vi) == 0:
+                        return []
+                    in_values.append(vi)
+                    clauses.append( (ki, None) )
+
+                elif vi is None or (type(vi) == str and vi == "NULL"):
+                    clauses.append( ("{} IS NULL".format(ki), []) )
+
+                else:
+                    clauses.append( ("{}=%s".format(ki), [vi]) )
+
+        def build(chunks):
+            chunks = iter(chunks)
+            bcondition, params = [], []
+            for ci, pi in clauses:
+                if pi is None:
+                    chunk = next(chunks)
+                    bcondition.append("{} IN ({})".format(ci, _placeholders(len(chunk))))
+                    params.extend(chunk)
                 else:
-                    bcondition += "{}={} AND ".format(ki, vi)
+                    bcondition.append(ci)
+                    params.extend(pi)
+            if bcondition:
+                return query + " WHERE {}".format(" AND ".join(bcondition)), params
+            return query, params
+
+        if len(in_values) == 0:
+            return [ build([]) ]
+
+        # >> IN (...) query, every list split into chunks; each row matches
+        # exactly one combination of chunks, so the results do not overlap
+        # and no statement binds more than max_in_params values per list
+        chunked = [ _chunks(values, self.max_in_params) for values in in_values ]
+
+        return [ build(combination) for combination in itertools.product(*chunked) ]
 
-            condition = bcondition[:-5]
 
-            query = query + " WHERE {}".format(condition)
+    def _fetch_prepared(self, query, params, verbose=False):
+        """ run a prepared statement, return the rows as a list of dicts
+        """
 
         if verbose:
-            print("{}: MySQL: {}".format(datetime.now().time(), query))
+            print("{}: MySQL: {} {}".format(datetime.now().time(), query, params))
 
-        cursor = self.execute(query)
-        result = cursor.fetchall()
+        cursor = self._statement(query)
+        cursor.execute(query, tuple(params))
 
-        cursor.close()
+        columns = cursor.column_names
+        result = [ dict(zip(columns, row)) for row in cursor.fetchall() ]
 
         return result
 
 
+    def _statement(self, query):
+        """ return a prepared cursor for query, preparing it only once
+        per connection
+        """
+
+        # auto-connect
+        self._ensure_connected()
+
+        statements = self._statements
+        if query in statements:
+            statements.move_to_end(query)
+        else:
+            statements[query] = self.connection.cursor(prepared=True)
+            while len(statements) > self.max_statements:
+                _, cursor = statements.popitem(last=False)
+                cursor.close()
+
+        return statements[query]
+
+
     def insert(self, table, data, verbose=False):
         """ insert data into a table
         data is a dictionary, eg.  
@@ -248,3 +607,74 @@ class SQL(object):
         return
 
 
+    def insert_many(self, table, rows, chunk_size=500, verbose=False):
+        """ insert a list of dictionaries into a table
+        rows are grouped by their set of columns and sent as multi-row
+        INSERTs with bound parameters, each chunk of `chunk_size` rows
+        runs inside a single transaction
+
+        returns the number of rows inserted; if a chunk fails it is
+        rolled back and retried row-by-row, rows that still fail are
+        reported and skipped
+        """
+
+        # rows with different columns need different statements
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+
+        n_inserted = 0
+        for columns, group in groups.items():
+
+            query = "INSERT INTO {} ({}) VALUES ({})".format(
+                        table,
+                        ", ".join(columns),
+                        ", ".join(["%s"] * len(columns)),
+                    )
+
+            for i in range(0, len(group), chunk_size):
+                chunk  = group[i:i+chunk_size]
+                values = [ tuple(_bindable(r[c]) for c in columns) for r in chunk ]
+
+                try:
+                    self._transaction(query, values, verbose=verbose)
+                    n_inserted += len(chunk)
+
+                except connector.Error as err:
+                    print("! chunk insert into {} failed ({}), "
+                          "retrying row-by-row".format(table, err))
+                    for row, value in zip(chunk, values):
+                        try:
+                            self._transaction(query, [value], verbose=verbose)
+                            n_inserted += 1
+                        except connector.Error as err:
+                            print("! could not insert {}".format(row))
+                            print(err)
+
+        return n_inserted
+
+
+    def _transaction(self, query, values, verbose=False):
+        """ run executemany inside one transaction, rollback on error
+        """
+
+        if verbose:
+            print("{}: MySQL: {} x{}".format(datetime.now().time(), query, len(values)))
+
+        # auto-connect
+        self._ensure_connected()
+
+        self.connection.start_transaction()
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany(query, values)
+            self.connection.commit()
+        except connector.Error:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        return
+
+
@@ -1,80 +1,183 @@
 
 import time
 import argparse
+import multiprocessing
 
 from xia2pipe.projbase import ProjectBase
 
 
+# the daemon a forked harvesting worker parses results for
+_HARVESTER = None
+
+
+def _init_worker():
+    # the parent closed its DB connections before forking, make sure
+    # the child starts from a clean slate all the same
+    _HARVESTER.db.reset()
+    return
+
+
+def _parse_one(daemon, fetcher_name, md, run):
+    """
+    Return (md, run, data, error), never raises
+    """
+    try:
+        data = getattr(daemon, fetcher_name)(md, run)
+        return md, run, data, None
+    except Exception as e:
+        return md, run, None, str(e)
+
+
+def _harvest_one(args):
+    return _parse_one(_HARVESTER, *args)
+
+
 class DBDaemon(ProjectBase):
     """
     Run through the data and update the SQL DB accordingly
     """
 
-    def in_db(self, metadata, run, table):
+    def stored_keys(self, table):
+        """
+        Return the set of (crystal_id, run) already stored in `table`
+        for the configured method, using one query per table involved.
+        """
 
-        cid = self.metadata_to_id(metadata, run) # crystal ID
+        reductions = self.db.select(['data_reduction_id', 'crystal_id', 'run_id'],
+                                    '{}.Data_Reduction'.format(self._analysis_db),
+                                    {'method' : self.reduction_pipeline_name})
 
         if table == 'Data_Reduction':
-            try:
-                k = self.get_reduction_id(cid, run)
-            except OSError as e:
-                k = []
+            keys = set([ (r['crystal_id'], r['run_id']) for r in reductions ])
 
         elif table == 'Refinement':
-            try:
-                k = self.get_refinement_id(cid, run)
-            except OSError as e:
-                k = []
+            refinements = self.db.select('data_reduction_id',
+                                         '{}.Refinement'.format(self._analysis_db),
+                                         {'method' : self.refinement_config['method_name']})
+            refined = set([ r['data_reduction_id'] for r in refinements ])
+            keys = set([ (r['crystal_id'], r['run_id']) for r in reductions
+                         if r['data_reduction_id'] in refined ])
 
         else:
             raise ValueError('`table` must be Data_Reduction, Refinement'
-                             ' got: {}'.format(which))
+                             ' got: {}'.format(table))
 
-        if k:
-            exists = True
-        else:
-            exists = False
+        return keys
+
+
+    def missing_from_db(self, list_to_check, table):
+        """
+        Split list_to_check into those (md, run) not yet in `table`
+        and the number already stored
+        """
+
+        stored = self.stored_keys(table)
+
+        missing = []
+        n_already = 0
+        for md, run in list_to_check:
+            try:
+                cid = self.metadata_to_id(md, run)
+            except OSError:
+                cid = None # let the data fetcher report the problem
+
+            if (cid, run) in stored:
+                n_already += 1
+            else:
+                missing.append( (md, run) )
+
+        return missing, n_already
 
-        return exists
 
+    def _harvest(self, data_fetcher, list_to_parse, workers=1):
+        """
+        Parse results for each (md, run), yielding (md, run, data, error)
+        as they become available; error is None on success.
 
-    def _update(self, table, list_to_check, data_fetcher, to_file=None):
+        The file parsers are memoised (see ParseMemo), so re-parsing an
+        unchanged result is cheap. With workers > 1, parsing runs in a
+        pool of forked processes and results arrive in completion order.
+        """
+
+        todo = list(list_to_parse)
+
+        if workers <= 1 or len(todo) <= 1:
+            results = ( _parse_one(self, data_fetcher.__name__, md, run)
+                        for md, run in todo )
+            for md, run, data, error in results:
+                yield md, run, data, error
+            return
+
+        # everything the workers need from the DB should be loaded
+        # before forking; they inherit it, but open their own connections
+        self.load_diffractions()
+
+        # no DB socket may be shared with the children: closing it there
+        # would end the session of the parent too. The parent reconnects
+        # on its next query, after the fork.
+        self.db.close()
+
+        global _HARVESTER
+        _HARVESTER = self
+
+        ctx  = multiprocessing.get_context('fork')
+        args = [ (data_fetcher.__name__, md, run) for md, run in todo ]
+
+        with ctx.Pool(workers, initializer=_init_worker) as pool:
+            for md, run, data, error in pool.imap_unordered(_harvest_one, args,
+                                                            chunksize=4):
+                yield md, run, data, error
+
+        return
+
+
+    def _update(self, table, list_to_check, data_fetcher, to_file=None,
+                batch_size=500, workers=1):
         """
         table : Data_Reduction or Refinement
         list_to_check : [(md, run), (md, run), ...]
         data_fetcher : self.xia_data, self.dmpl_data
+        batch_size : number of rows sent to the DB per INSERT transaction
+        workers : number of processes parsing results
         """
 
         n_inserted = 0
-        n_already  = 0
-
-        for md, run in list_to_check:
-
-            if not self.in_db(md, run, table):
-
-                try:
-                    data = data_fetcher(md, run)
-                except Exception as e:
-                    print('! issue with {} {}'.format(md, run))
-                    print(e)
-                    continue
-
-                if float('nan') in data.values():
-                    print('nan in values!', data)
-                    continue
-
-                if to_file:
-                    columns = ', '.join(list(data.keys()))
-                    values  = ', '.join(["'%s'"%v if v else "NULL" for v in data.values()])
-                    to_file.write('INSERT INTO SARS_COV_2_Analysis_v2.{} ({}) VALUES ({});'
-                                  '\n'.format(table, columns, values))
-                else:
-                    self.db.insert('{}.{}'.format(self._analysis_db, table),
-                                   data,
-                                   verbose=False)
+        to_insert, n_already = self.missing_from_db(list_to_check, table)
+        batch = []
+
+        def flush(batch):
+            return self.db.insert_many('{}.{}'.format(self._analysis_db, table),
+                                       batch,
+                                       chunk_size=batch_size,
+                                       verbose=False)
+
+        # this process is the single writer, parsers stream rows to it
+        for md, run, data, error in self._harvest(data_fetcher, to_insert,
+                                                  workers=workers):
+
+            if error is not None:
+                print('! issue with {} {}'.format(md, run))
+                print(error)
+                continue
+
+            if float('nan') in data.values():
+                print('nan in values!', data)
+                continue
+
+            if to_file:
+                columns = ', '.join(list(data.keys()))
+                values  = ', '.join(["'%s'"%v if v else "NULL" for v in data.values()])
+                to_file.write('INSERT INTO SARS_COV_2_Analysis_v2.{} ({}) VALUES ({});'
+                              '\n'.format(table, columns, values))
                 n_inserted += 1
             else:
-                n_already += 1
+                batch.append(data)
+                if len(batch) >= batch_size:
+                    n_inserted += flush(batch)
+                    batch = []
+
+        if batch:
+            n_inserted += flush(batch)
 
         print('')
         print('> {:14s} ---'.format(table))
@@ -84,19 +187,23 @@ class DBDaemon(ProjectBase):
         return
 
 
-    def update_xia(self, to_file=None):
+    def update_xia(self, to_file=None, batch_size=500, workers=1):
         self._update('Data_Reduction',
                      self.fetch_reduction_successes(),
                      self.xia_data,
-                     to_file=to_file)
+                     to_file=to_file,
+                     batch_size=batch_size,
+                     workers=workers)
         return
 
 
-    def update_dimpling(self, to_file=None):
+    def update_dimpling(self, to_file=None, batch_size=500, workers=1):
         self._update('Refinement',
                      self.fetch_dmpl_successes(),
                      self.dmpl_data,
-                     to_file=to_file)
+                     to_file=to_file,
+                     batch_size=batch_size,
+                     workers=workers)
         return
 
 
@@ -109,6 +216,10 @@ def script():
                         help='write the SQL commands to a file for later upload')
     parser.add_argument('--direct', action='store_true', default=False,
                         help='directly inject results into DB')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='rows per INSERT transaction with --direct')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing results in parallel')
     args = parser.parse_args()
 
     dbd = DBDaemon.load_config(args.config)
@@ -121,16 +232,18 @@ def script():
 
     if args.outfile:
         print('writing --> {}'.format(args.outfile))
+        dbd.scan_results() # once, for both updates
         with open(args.outfile, 'w') as f:
-            dbd.update_xia(to_file=f)
-            dbd.update_dimpling(to_file=f)
+            dbd.update_xia(to_file=f, workers=args.workers)
+            dbd.update_dimpling(to_file=f, workers=args.workers)
 
     elif args.direct:
        print('--> direct injection to SQL requested')
        conf = input('    are you sure? [y/n] ')
        if conf in ['y', 'Y', 'yes', 'Yes', 'YES']:
-           dbd.update_xia()
-           dbd.update_dimpling()
+           dbd.scan_results() # once, for both updates
+           dbd.update_xia(batch_size=args.batch_size, workers=args.workers)
+           dbd.update_dimpling(batch_size=args.batch_size, workers=args.workers)
 
     else:
         raise RuntimeError('must provide `outfile` or set `--direct`')
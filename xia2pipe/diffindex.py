@@ -0,0 +1,97 @@
+"""
+An in-memory snapshot of the SARS_COV_2_v2.Diffractions table
+"""
+
+from xia2pipe.connector import get_single
+
+
+DIFFRACTIONS_TABLE = 'SARS_COV_2_v2.Diffractions'
+
+
+class DiffractionIndex:
+    """
+    Loads the Diffractions table in one bulk query and serves
+    lookups in both directions from memory:
+
+      (metadata, run)   --> crystal_id, raw data pattern, diffraction
+      (crystal_id, run) --> metadata
+
+    The snapshot is not updated automatically, call refresh() to
+    pick up new rows from the database.
+    """
+
+    fields = ['crystal_id',
+              'metadata',
+              'run_id',
+              'data_raw_filename_pattern',
+              'diffraction']
+
+    def __init__(self, db, table=DIFFRACTIONS_TABLE):
+
+        self.db    = db
+        self.table = table
+
+        self._by_metadata = {} # (metadata, run)   --> [row, row, ...]
+        self._by_id       = {} # (crystal_id, run) --> [row, row, ...]
+
+        self.refresh()
+
+        return
+
+
+    def refresh(self):
+        """
+        Re-load the entire table from the database
+        """
+
+        rows = self.db.select(self.fields, self.table)
+
+        by_metadata = {}
+        by_id       = {}
+        for row in rows:
+            by_metadata.setdefault((row['metadata'], row['run_id']), []).append(row)
+            by_id.setdefault((row['crystal_id'], row['run_id']), []).append(row)
+
+        self._by_metadata = by_metadata
+        self._by_id       = by_id
+
+        return
+
+
+    def __len__(self):
+        return sum([ len(rows) for rows in self._by_metadata.values() ])
+
+
+    def __contains__(self, md):
+        return tuple(md) in self._by_metadata
+
+
+    def metadata_to_id(self, metadata, run):
+
+        rows = self._by_metadata.get((metadata, run), [])
+
+        if len(rows) == 0:
+            raise IOError('no crystal_id in database for '
+                          'metadata={}, run={}'.format(metadata, run))
+        if len( set([ x['crystal_id'] for x in rows ]) ) > 1: # check unique
+            raise IOError('found multiple irreconcilable crystal_id`s in db for '
+                          'metadata={}, run={}'.format(metadata, run))
+
+        return rows[0]['crystal_id']
+
+
+    def id_to_metadata(self, crystal_id, run):
+        rows = self._by_id.get((crystal_id, run), [])
+        return get_single(rows, crystal_id, run, 'metadata')
+
+
+    def data_pattern(self, crystal_id, run):
+        rows = self._by_id.get((crystal_id, run), [])
+        return get_single(rows, crystal_id, run, 'data_raw_filename_pattern')
+
+
+    def diffraction(self, crystal_id, run):
+        rows = self._by_id.get((crystal_id, run), [])
+        return get_single(rows, crystal_id, run, 'diffraction')
+
+
@@ -1,12 +1,15 @@
 
 import os
-import re
+import sys
 import time
 import subprocess
 import argparse
+from itertools import islice
 from os.path import join as pjoin
 
-from xia2pipe.projbase import ProjectBase, ResolutionError
+from xia2pipe.projbase import ProjectBase
+from xia2pipe.slurmjobs import ARRAY_NAME, read_manifest
+from xia2pipe.resources import largest
 
 
 class DimplingDaemon(ProjectBase):
@@ -14,22 +17,10 @@ class DimplingDaemon(ProjectBase):
 
     def fetch_running_jobs(self):
         """
-        Return a list of metadata str that are running on SLURM
+        Return a list of (metadata, run) that are running on SLURM
         """
-
-        running = []
-
-        r = subprocess.run('sacct --format="JobID,JobName%50" --state="RUNNING,PENDING"',
-                           capture_output=True, shell=True, check=True)
-
-        lines = r.stdout.decode("utf-8").split('\n')
-        for line in lines:
-            g = re.search('{}-dmpl_(\w+)-(\d)'.format(self.name), line)
-            if g:
-                grps = g.groups()
-                running.append( (grps[0], int(grps[1])) ) # metadata, run_id
-
-        return running
+        return list(self.jobs.index('{}-dmpl_'.format(self.name),
+                                    manifest_dir=self.array_dir).keys())
 
 
     def fetch_input_mtz(self, metadata, run):
@@ -69,7 +60,15 @@ class DimplingDaemon(ProjectBase):
         return i_mtz
 
 
-    def submit_unfinished(self, limit=None, verbose=True):
+    def submit_unfinished(self, limit=None, verbose=True, full_scan=False):
+        """
+        Submit refinement for every xia2 result that is not yet refined,
+        failed or running.
+
+        With a `limit`, the checks stop as soon as that many datasets to
+        submit are found (see iter_unfinished); full_scan=True checks
+        every dataset and reports the counts at each stage.
+        """
 
         # TODO
         # this code is almost the same as in xiadaemon... can we combine?
@@ -80,6 +79,66 @@ class DimplingDaemon(ProjectBase):
         print('>> dimpling daemon crunching latest results...')
         print('>>', current_time)
 
+        if full_scan or (limit is None):
+            to_run, fields = self.rank_candidates(self._scan_unfinished(verbose=verbose))
+            to_run = list(islice(self.apply_quotas(to_run, fields), limit))
+        else:
+            to_run = list(islice(self.iter_unfinished(), limit))
+
+        # submit the rest
+        if verbose:
+            print('Submitting:                      {}'.format(len(to_run)))
+
+        to_submit = list(to_run)[:limit]
+        if self.slurm_config.get('array', False):
+            self.submit_batch(to_submit)
+        else:
+            scripts, failed = self.prepare_jobs(to_submit, self.write_script)
+            self.submit_scripts('{}-dmpl_'.format(self.name), scripts, failed=failed)
+
+        # the cached job snapshot no longer includes what we submitted
+        if len(to_run) > 0:
+            self.jobs.invalidate()
+
+        return
+
+
+    def iter_unfinished(self):
+        """
+        Lazily yield the (metadata, run) to submit, in priority order,
+        cheapest check first: not running on SLURM, no refinement result,
+        xia2 mtz present
+        """
+
+        running = set(self.fetch_running_jobs())
+
+        # a dataset may have more than one reduction row
+        mtzs = {}
+        for metadata, run, mtz_path in self.fetch_reduction_mtzs():
+            mtzs.setdefault( (metadata, run), [] ).append(mtz_path)
+
+        # highest priority first, see rank_candidates
+        ranked, fields = self.rank_candidates(mtzs.keys())
+
+        candidates = ( md for md in ranked if md not in running )
+
+        candidates = self.probe_filter(self.dmpl_result, candidates,
+                                       keep=lambda r: r not in ['finished', 'procfail'])
+
+        has_mtz = lambda metadata, run: any([ os.path.exists(p) for p in mtzs[(metadata, run)] ])
+        candidates = self.probe_filter(has_mtz, candidates)
+
+        return self.apply_quotas(candidates, fields)
+
+
+    def _scan_unfinished(self, verbose=True):
+        """
+        Check every dataset at every stage, return the set to submit
+        """
+
+        # one pass over the results tree serves all status checks below
+        self.scan_results()
+
         # get sucessfully completed xia2 runs
         to_run = set(self.fetch_reduction_successes(in_db=True))
         if verbose:
@@ -89,11 +148,12 @@ class DimplingDaemon(ProjectBase):
         to_rm = []
         successes = 0
         failures  = 0
-        for md in to_run:
-            if self.dmpl_result(*md) == 'finished':
+        candidates = list(to_run)
+        for md, result in zip(candidates, self.probe(self.dmpl_result, candidates)):
+            if result == 'finished':
                 to_rm.append(md)
                 successes += 1
-            elif self.dmpl_result(*md) == 'procfail':
+            elif result == 'procfail':
                 to_rm.append(md)
                 failures  += 1
         to_run = to_run - set(to_rm)
@@ -107,27 +167,13 @@ class DimplingDaemon(ProjectBase):
         if verbose:
             print('Running on SLURM:                {}'.format(len(running)))
 
-        # submit the rest
-        if verbose:
-            print('Submitting:                      {}'.format(len(to_run)))
-
-        for md in list(to_run)[:limit]:
-            try:
-                self.submit_run(*md)
-            except ResolutionError as e:
-                print(e)
-
-        return
-
-
-    def submit_run(self, metadata, run, debug=False, nproc=1):
+        return to_run
 
-        # -- figure out some flags
 
-        # >> place for results
-        outdir = self.metadata_to_outdir(metadata, run)
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
+    def _refinement_flags(self):
+        """
+        Return the reference_pdb, water and forcedown arguments for dmpl.sh
+        """
 
         # >> reference PDB(s)
         if 'reference_pdb' not in self.refinement_config.keys():
@@ -155,6 +201,45 @@ class DimplingDaemon(ProjectBase):
         else:
             forcedown_str = ''
 
+        return ref_pdb, water_str, forcedown_str
+
+
+    def write_script(self, metadata, run, nproc=1, input_mtz=None,
+                     resolution=None, dependency=None, preamble=''):
+        """
+        Write the SLURM script for one dataset, return its path.
+
+        input_mtz and resolution default to the values in the database;
+        `dependency` is a SLURM job id to run after, and `preamble` is
+        shell code run before dmpl.sh.
+        """
+
+        if input_mtz is None:
+            input_mtz = self.fetch_input_mtz(metadata, run)
+        if resolution is None:
+            resolution = self.get_refinement_res(metadata, run)
+
+        if dependency is not None:
+            dependency_str = ('#SBATCH --dependency=afterok:{}\n'
+                              '#SBATCH --kill-on-invalid-dep=yes'.format(dependency))
+        else:
+            dependency_str = ''
+
+        # cores, memory & walltime learnt from past jobs, if enabled;
+        # the resolution is not known yet for a chained job
+        resources = self.job_resources('{}-dmpl_'.format(self.name), metadata, run,
+                                       resolution=resolution if isinstance(resolution, float) else None)
+        nproc, header = self.resource_request(resources, nproc, cores=nproc,
+                                              mem='6GB', walltime='10:00:00')
+
+        # -- figure out some flags
+
+        # >> place for results
+        outdir = self.metadata_to_outdir(metadata, run)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        ref_pdb, water_str, forcedown_str = self._refinement_flags()
 
         # -- then write and sub the slurm script
         batch_script="""#!/bin/bash
@@ -164,12 +249,13 @@ class DimplingDaemon(ProjectBase):
 #SBATCH --nodes=1
 #SBATCH --oversubscribe
 #SBATCH --ntasks=1
-#SBATCH --cpus-per-task={nproc}
-#SBATCH --mem=6GB
-#SBATCH --time=10:00:00
+{resources}
 #SBATCH --job-name  {name}-dmpl_{metadata}-{run}
 #SBATCH --output    {outdir}/{name}-dmpl_{metadata}-{run}.out
 #SBATCH --error     {outdir}/{name}-dmpl_{metadata}-{run}.err
+{dependency}
+
+{preamble}
 
 export LD_PRELOAD=""
 source /etc/profile.d/modules.sh
@@ -196,13 +282,16 @@ source /home/tjlane/opt/phenix/phenix-1.18-3861/phenix_env.sh
                     metadata        = metadata,
                     outdir          = outdir,
                     run             = run,
-                    resolution      = self.get_refinement_res(metadata, run),
-                    input_mtz       = self.fetch_input_mtz(metadata, run),
+                    resolution      = resolution,
+                    input_mtz       = input_mtz,
                     reference_pdb   = ref_pdb,
                     free_mtz        = self.refinement_config.get('free_flag_mtz', ''),
                     water_flag      = water_str,
                     nproc           = nproc,
                     forcedown_flag  = forcedown_str,
+                    dependency      = dependency_str,
+                    preamble        = preamble,
+                    resources       = header,
                   )
 
         # create a slurm sub script
@@ -210,6 +299,39 @@ source /home/tjlane/opt/phenix/phenix-1.18-3861/phenix_env.sh
         with open(slurm_file, 'w') as f:
             f.write(batch_script)
 
+        return slurm_file
+
+
+    def write_chained_script(self, metadata, run, xia_outdir, after, nproc=1):
+        """
+        Write the SLURM script to refine the output of xia2 job `after`,
+        which writes to xia_outdir. The job starts once xia2 succeeded and
+        reads the mtz and resolution from its output on disk.
+        """
+
+        input_mtz = pjoin(xia_outdir, 'DataFiles',
+                          'SARSCOV2_{}_{:03d}_free.mtz'.format(metadata, run))
+
+        # the daemon's own interpreter has xia2pipe installed; the json
+        # is looked up like xia_data does, once xia2 has written it
+        preamble = ('resolution=$({python} -m xia2pipe.xia2json {outdir} {metadata} {run} '
+                    '{rescut}) || exit 1'.format(python   = sys.executable,
+                                                 outdir   = xia_outdir,
+                                                 metadata = metadata,
+                                                 run      = run,
+                                                 rescut   = self.refinement_config.get('rescut', -1.0)))
+
+        return self.write_script(metadata, run, nproc=nproc,
+                                 input_mtz=input_mtz,
+                                 resolution='$resolution',
+                                 dependency=after,
+                                 preamble=preamble)
+
+
+    def submit_run(self, metadata, run, debug=False, nproc=1):
+
+        slurm_file = self.write_script(metadata, run, nproc=nproc)
+
         # submit to queue and cleanup
         if not debug:
             r = subprocess.run("/usr/bin/sbatch {}".format(slurm_file),
@@ -224,6 +346,99 @@ source /home/tjlane/opt/phenix/phenix-1.18-3861/phenix_env.sh
         return
 
 
+    def submit_batch(self, mds, debug=False, nproc=1):
+        """
+        Submit many (metadata, run) as a SLURM job array, see submit_array
+        """
+
+        ref_pdb, water_str, forcedown_str = self._refinement_flags()
+
+        def make_row(metadata, run):
+
+            resolution = self.get_refinement_res(metadata, run)
+            input_mtz  = self.fetch_input_mtz(metadata, run)
+
+            outdir = self.metadata_to_outdir(metadata, run)
+            if not os.path.exists(outdir):
+                os.makedirs(outdir)
+
+            return {'metadata'   : metadata,
+                    'run'        : run,
+                    'outdir'     : outdir,
+                    'resolution' : resolution,
+                    'mtz'        : input_mtz}
+
+        rows, failed = self.prepare_jobs(mds, make_row)
+        rows = [ row for md, row in rows ]
+
+        def make_script(manifest):
+
+            # all tasks share one request, large enough for each of them
+            resources = largest([ self.job_resources('{}-dmpl_'.format(self.name),
+                                                     row['metadata'], int(row['run']),
+                                                     resolution=float(row['resolution']))
+                                  for row in read_manifest(manifest) ])
+            task_nproc, header = self.resource_request(resources, nproc, cores=nproc,
+                                                       mem='6GB', walltime='10:00:00')
+
+            return """#!/bin/bash
+
+#SBATCH --partition={partition}
+#SBATCH --reservation={rsrvtn}
+#SBATCH --nodes=1
+#SBATCH --oversubscribe
+#SBATCH --ntasks=1
+{resources}
+#SBATCH --job-name  {name}-dmpl_{array}
+#SBATCH --output    {array_dir}/{name}-dmpl_{array}-%A_%a.out
+
+row=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {manifest})
+metadata=$(echo "$row" | cut -f1)
+run=$(echo "$row" | cut -f2)
+outdir=$(echo "$row" | cut -f3)
+resolution=$(echo "$row" | cut -f5)
+input_mtz=$(echo "$row" | cut -f6)
+
+exec > $outdir/{name}-dmpl_${{metadata}}-${{run}}.out \
+    2> $outdir/{name}-dmpl_${{metadata}}-${{run}}.err
+
+export LD_PRELOAD=""
+source /etc/profile.d/modules.sh
+
+module load ccp4/7.0
+#module load phenix/1.18 # real_space_refine has bug
+source /home/tjlane/opt/phenix/phenix-1.18-3861/phenix_env.sh
+
+/home/tjlane/opt/xia2pipe/scripts/dmpl.sh \
+  --dir=$outdir                                     \
+  --metadata=${{metadata}}_$(printf '%03d' $run)    \
+  --resolution=$resolution                          \
+  --refpdb={reference_pdb}                          \
+  --mtzin=$input_mtz                                \
+  --freemtz={free_mtz}                              \
+  {water_flag}                                      \
+  --nproc={nproc}                                   \
+  {forcedown_flag}
+
+""".format(
+                        name            = self.name,
+                        array           = ARRAY_NAME,
+                        array_dir       = self.array_dir,
+                        manifest        = manifest,
+                        partition       = self.slurm_config.get('partition', 'all'),
+                        rsrvtn          = self.slurm_config.get('reservation', ''),
+                        reference_pdb   = ref_pdb,
+                        free_mtz        = self.refinement_config.get('free_flag_mtz', ''),
+                        water_flag      = water_str,
+                        nproc           = task_nproc,
+                        forcedown_flag  = forcedown_str,
+                        resources       = header,
+                      )
+
+        return self.submit_array('{}-dmpl_'.format(self.name), rows,
+                                 make_script, debug=debug, failed=failed)
+
+
 def script():
 
     parser = argparse.ArgumentParser(description='Submit new refinement jobs.')
@@ -231,10 +446,12 @@ def script():
                         help='the configuration yaml file to use')
     parser.add_argument('--limit', type=int, default=None,
                         help='max number of jobs to submit')
+    parser.add_argument('--full-scan', action='store_true',
+                        help='check every dataset and report counts, even with --limit')
     args = parser.parse_args()
 
     dd = DimplingDaemon.load_config(args.config)
-    dd.submit_unfinished(verbose=True, limit=args.limit)
+    dd.submit_unfinished(verbose=True, limit=args.limit, full_scan=args.full_scan)
 
     return
 
@@ -0,0 +1,146 @@
+"""
+On-disk memoisation of file parsers
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memo (
+    func        TEXT    NOT NULL,
+    path        TEXT    NOT NULL,
+    size        INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    value       TEXT,
+    nbytes      INTEGER,
+    last_used   REAL,
+    PRIMARY KEY (func, path)
+);
+CREATE INDEX IF NOT EXISTS memo_lru ON memo (last_used);
+"""
+
+
+class ParseMemo:
+    """
+    Remembers what a parser returned (or raised) for a file, keyed by
+    (parser, path) and valid for as long as the file size and mtime are
+    unchanged. Results must be JSON-serialisable. A parser whose output
+    changes sets a new `memo_version` attribute, so that older entries
+    are ignored.
+
+    The store is an SQLite file; once its content exceeds max_bytes,
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_bytes=256*1024**2):
+
+        self.path      = path
+        self.max_bytes = max_bytes
+
+        self._lock  = threading.RLock()
+        self._conn  = None
+        self._pid   = None
+        self._total = None # bytes stored, approximate if shared
+
+        return
+
+
+    @property
+    def conn(self):
+        # a forked child must not use its parent's connection
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            # the memo is on the shared filesystem and used by daemons on
+            # several nodes: WAL needs shared memory between them, so keep
+            # the rollback journal (and switch back files once set to WAL)
+            self._conn.execute('PRAGMA journal_mode=DELETE')
+            self._conn.executescript(_SCHEMA)
+            self._pid   = os.getpid()
+            self._total = self._conn.execute('SELECT COALESCE(SUM(nbytes), 0) '
+                                             'FROM memo').fetchone()[0]
+        return self._conn
+
+
+    def call(self, func, path):
+        """
+        Return func(path), from the memo if path is unchanged
+        """
+
+        st   = os.stat(path) # raises if path does not exist, like func would
+        name = '{}.{}'.format(func.__module__, func.__qualname__)
+        if getattr(func, 'memo_version', None):
+            name += '@{}'.format(func.memo_version)
+
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM memo WHERE func = ? AND path = ? '
+                                    'AND size = ? AND mtime_ns = ?',
+                                    (name, path, st.st_size, st.st_mtime_ns)).fetchone()
+            if row is not None:
+                self.conn.execute('UPDATE memo SET last_used = ? WHERE func = ? AND path = ?',
+                                  (time.time(), name, path))
+                return _unpack(row[0])
+
+        try:
+            result = {'value' : func(path)}
+        except (OSError, ValueError, KeyError, RuntimeError) as e:
+            # parse failures are remembered too, so they are not retried
+            # until the file changes
+            result = {'error' : type(e).__name__, 'message' : str(e)}
+
+        value = json.dumps(result)
+
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO memo '
+                              '(func, path, size, mtime_ns, value, nbytes, last_used) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (name, path, st.st_size, st.st_mtime_ns, value,
+                               len(value), time.time()))
+            self._total += len(value)
+            self._evict()
+
+        return _unpack(value)
+
+
+    def _evict(self):
+
+        if self._total <= self.max_bytes:
+            return
+
+        # drop the least recently used entries until 90% full
+        self._total = self.conn.execute('SELECT COALESCE(SUM(nbytes), 0) '
+                                        'FROM memo').fetchone()[0]
+        excess = self._total - int(0.9 * self.max_bytes)
+        rows = self.conn.execute('SELECT func, path, nbytes FROM memo '
+                                 'ORDER BY last_used ASC').fetchall()
+        to_drop = []
+        for func, path, nbytes in rows:
+            if excess <= 0:
+                break
+            to_drop.append( (func, path) )
+            excess      -= nbytes
+            self._total -= nbytes
+
+        self.conn.execute('BEGIN')
+        self.conn.executemany('DELETE FROM memo WHERE func = ? AND path = ?', to_drop)
+        self.conn.execute('COMMIT')
+
+        return
+
+
+_ERRORS = {'OSError' : OSError, 'FileNotFoundError' : FileNotFoundError,
+           'ValueError' : ValueError, 'KeyError' : KeyError,
+           'RuntimeError' : RuntimeError}
+
+
+def _unpack(value):
+    result = json.loads(value)
+    if 'error' in result:
+        raise _ERRORS.get(result['error'], OSError)(result['message'])
+    return result['value']
+
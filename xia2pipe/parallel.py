@@ -0,0 +1,56 @@
+"""
+Concurrency helpers for the latency-bound filesystem checks
+"""
+
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+
+def probe_map(fn, mds, width=1):
+    """
+    Return [fn(*md) for md in mds], computed by a bounded pool of
+    `width` threads; results are in the same order as mds.
+
+    The per-dataset checks (raw data, xia/dmpl results) spend their time
+    waiting on GPFS metadata operations, not on the CPU, so threads
+    overlap them well despite the GIL.
+    """
+
+    mds = list(mds)
+
+    if width is None or width <= 1 or len(mds) <= 1:
+        return [ fn(*md) for md in mds ]
+
+    with ThreadPoolExecutor(max_workers=width) as pool:
+        return list(pool.map(lambda md: fn(*md), mds))
+
+
+
+def probe_filter(fn, mds, keep=bool, width=1, chunk_size=None):
+    """
+    Lazily yield each md in mds for which keep(fn(*md)) is true.
+
+    mds are consumed in chunks of `chunk_size` (default 4 * width) that
+    are checked on the thread pool, so a consumer that stops early costs
+    at most one chunk of checks beyond what it used.
+    """
+
+    if chunk_size is None:
+        chunk_size = 4 * width if (width and width > 1) else 1
+
+    mds = iter(mds)
+
+    if width is None or width <= 1:
+        for md in mds:
+            if keep(fn(*md)):
+                yield md
+        return
+
+    with ThreadPoolExecutor(max_workers=width) as pool:
+        while True:
+            chunk = list(islice(mds, chunk_size))
+            if len(chunk) == 0:
+                return
+            for md, result in zip(chunk, pool.map(lambda md: fn(*md), chunk)):
+                if keep(result):
+                    yield md
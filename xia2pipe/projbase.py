@@ -4,10 +4,11 @@ import os
 import sys
 import re
 import yaml
-import json
 import ast
 import time
+import threading
 import configparser
+import tempfile
 import subprocess
 
 from glob import glob
@@ -17,6 +18,19 @@ from math import isnan
 from numpy import argmin
 
 from xia2pipe.connector import SQL, get_single
+from xia2pipe.diffindex import DiffractionIndex
+from xia2pipe.resultscan import ResultsIndex, _scandir
+from xia2pipe.statestore import StateStore
+from xia2pipe.rawindex import RawDataIndex
+from xia2pipe.parallel import probe_map, probe_filter
+from xia2pipe.xia2json import read_xia2_json, find_xia2_json
+from xia2pipe.bfactors import header_mean_b, b_factor_statistics
+from xia2pipe.memo import ParseMemo
+from xia2pipe.slurmjobs import (JobSnapshot, ARRAY_NAME, write_manifest, completed_jobs,
+                                match_jobs, array_tasks)
+from xia2pipe.submitter import Submitter, SubmitResult
+from xia2pipe.scheduler import PriorityScheduler
+from xia2pipe.resources import ResourceModel
 
 
 class ResolutionError(Exception):
@@ -38,43 +52,69 @@ def _count_blobs(log_handle):
 
 
 def _get_average_model_b(pdb_path):
+    # only the header is read, up to the first atom record
+    return header_mean_b(pdb_path)
 
-    p = 'MEAN B VALUE\s+\(OVERALL, A\*\*2\) :\s+(\d+.\d+)'
 
-    with open(pdb_path, 'r') as f:
-        g = re.search(p, f.read())
+def _phenix_model_b(pdb_path):
+    # the mean B over all atoms, as phenix.b_factor_statistics reports
+    # it, computed natively rather than in a phenix subprocess
+    avg_model_b = b_factor_statistics(pdb_path)['all']['mean']
 
-    model_b = 'NULL'
-    if g:
-        if len(g.groups()) == 1:
-            model_b = float(g.groups()[0])
+    if avg_model_b is None:
+        raise RuntimeError('could not find b-factors in {}'.format(pdb_path))
 
-    return model_b
+    return avg_model_b
 
 
-def _phenix_model_b(pdb_path):
+def _phenix_log_stats(log_path, tail=65536):
+    """
+    Return the final statistics of a phenix.refine log,
 
-    ret = subprocess.run('phenix.b_factor_statistics {}'.format(pdb_path),
-                         capture_output=True,
-                         shell=True)
+        [r-work, r-free, bonds, angles, b_min, b_max, b_ave]
 
-    if ret.returncode != 0:
-        raise RuntimeError('could not run phenix.b_factor_statistics'
-                           '- check: your have phenix in your environment'
-                           '- check: {} exists'.format(pdb_path))
+    from its last `end:` line, i.e. the final macro-cycle. That line
+    sits in the summary at the end of the log, so only the last `tail`
+    bytes are read; the rest of the file is read only if it is not
+    found there.
+    """
 
-    p = '\| all     :\s+\d+\s+\d+\s+(\d+.\d+)\s+(\d+.\d+)\s+(\d+.\d+)'
-    g = re.search(p, ret.stdout.decode("utf-8"))
+    p = rb'end\:' + rb'\s+(\d+\.\d+)'*7
 
-    if not g:
-        raise RuntimeError('could not find b-factor in output of'
-                           'phenix.b_factor_statistics')
-    if not len(g.groups()) == 3:
-        raise RuntimeError('could not find b-factor in output of'
-                           'phenix.b_factor_statistics')
-    avg_model_b = float(g.groups()[2])
+    with open(log_path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - tail))
+        g = re.findall(p, f.read())
 
-    return avg_model_b
+        if len(g) == 0 and size > tail:
+            f.seek(0)
+            g = re.findall(p, f.read())
+
+    if len(g) == 0:
+        raise IOError('Could not parse: {}'.format(log_path))
+
+    return [ float(e) for e in g[-1] ]
+
+# the first `end:` line was parsed before
+_phenix_log_stats.memo_version = 2
+
+
+def _dimple_r_factors(log_path):
+    """
+    Return [free_r, overall_r] reported in a dimple.log
+    """
+
+    # it turns out the python config parser handles dimple.log
+    with open(log_path, 'r') as f:
+        txt = f.read()
+        free_g = re.search('free_r: (\d+\.\d+)', txt)
+        work_g = re.search('overall_r: (\d+\.\d+)', txt)
+
+    if not (free_g and work_g):
+        print(free_g, work_g)
+        raise IOError('cannot parse: {}'.format(log_path))
+
+    return [ float(free_g.groups()[0]), float(work_g.groups()[0]) ]
 
 
 def _get_pdb_chosen_by_dimple(dimple_log_path):
@@ -117,6 +157,18 @@ def _get_pdb_chosen_by_dimple(dimple_log_path):
     return pdb_path
 
 
+def _paths_exist(paths, width=1):
+    """
+    Check a batch of paths, each distinct path is only stat-ed once
+    Returns a dict path --> bool
+    """
+    paths  = [ p for p in set(paths) if p is not None ]
+    exists = probe_map(os.path.exists, [ (p,) for p in paths ], width=width)
+    ret = dict(zip(paths, exists))
+    ret[None] = False
+    return ret
+
+
 def filetime(path):
     tstmp = os.path.getmtime(path)
     return datetime.fromtimestamp(tstmp).strftime('%Y-%m-%d %H:%M:%S')
@@ -130,6 +182,14 @@ class ProjectBase:
           of the dbdaemon.
     """
 
+    # whether the datasets handled span several targets, so that the
+    # per-target priority bonuses and quotas apply
+    multi_target = True
+
+    # the job features known before a job is submitted, the only ones
+    # the resource model is fit on and predicts from
+    submit_features = ('frames', 'resolution', 'space_group')
+
     def __init__(self, 
                  name,
                  results_dir,
@@ -138,7 +198,13 @@ class ProjectBase:
                  sql_config={},
                  slurm_config={},
                  xia2_config={},
-                 refinement_config={}):
+                 refinement_config={},
+                 state_store=True,
+                 missing_recheck=3600,
+                 missing_recheck_max=604800,
+                 probe_threads=1,
+                 memo_max_mb=256,
+                 priority=None):
 
         self.name          = name
         self.results_dir   = results_dir
@@ -153,6 +219,58 @@ class ProjectBase:
         # connect to the SQL db
         self.db = SQL(sql_config)
 
+        # snapshot of the Diffractions table, loaded on first use
+        self._diffractions = None
+
+        # index of the rawdata_dirs, built on first use
+        self._raw_index = None
+
+        # snapshot of the results tree, see scan_results()
+        self.results_index = None
+
+        # snapshot of our SLURM jobs, taken on first use
+        self._jobs = None
+
+        # resource models learnt from completed jobs, see job_resources()
+        self._resource_models    = {}
+        self._reduction_features = None
+
+        # local record of dataset states, keeps rescans incremental
+        if state_store:
+            store_path = pjoin(self.results_dir, '{}.x2p.sqlite'.format(self.name))
+            self.state_store = StateStore(store_path, self.name)
+        else:
+            self.state_store = None
+
+        # datasets without raw data are re-checked with exponential
+        # backoff, starting after `missing_recheck` seconds [s]
+        self.missing_recheck     = missing_recheck
+        self.missing_recheck_max = missing_recheck_max
+        self._missing            = None  # see load_missing()
+        self._missing_new        = set()
+        self._missing_found      = set()
+        self._missing_lock       = threading.Lock()
+
+        # width of the thread pool used for per-dataset filesystem checks
+        self.probe_threads = probe_threads
+
+        # parsed file contents, re-used until the file changes
+        if memo_max_mb:
+            memo_path = pjoin(self.results_dir, '{}.x2p.memo.sqlite'.format(self.name))
+            self.parse_memo = ParseMemo(memo_path, max_bytes=memo_max_mb*1024**2)
+        else:
+            self.parse_memo = None
+
+        # order of submission, None keeps the discovery order
+        if priority is not None:
+            if not self.multi_target and (priority.get('targets') or priority.get('quotas')):
+                raise ValueError('priority targets and quotas have no effect for {}, '
+                                 'which only handles target: {}'
+                                 ''.format(type(self).__name__, self.target))
+            self.scheduler = PriorityScheduler(**priority)
+        else:
+            self.scheduler = None
+
         # save the slurm, xia2, refinement configuration
         self.slurm_config      = slurm_config
         self.xia2_config       = xia2_config
@@ -201,26 +319,507 @@ class ProjectBase:
         return self.db.config['database']
 
 
+    @property
+    def diffractions(self):
+        """
+        In-memory index of SARS_COV_2_v2.Diffractions, loaded once in a
+        single query. Call refresh_diffractions() to pick up new rows.
+        """
+        return self.load_diffractions()
+
+
+    def load_diffractions(self):
+        """
+        Load the Diffractions snapshot, if not loaded yet; call this before
+        probing from a thread pool or forking, so it is only built once
+        """
+        if self._diffractions is None:
+            self._diffractions = DiffractionIndex(self.db)
+        return self._diffractions
+
+
+    def refresh_diffractions(self):
+        self.diffractions.refresh()
+        return
+
+
+    @property
+    def raw_index(self):
+        """
+        Index of every dataset under the rawdata_dirs, with frame counts.
+        Call refresh_raw_index() to pick up new data.
+        """
+        return self.load_raw_index()
+
+
+    def load_raw_index(self):
+        """
+        Build the raw data index, if not built yet; see load_diffractions()
+        """
+        if self._raw_index is None:
+            self._raw_index = RawDataIndex(self.rawdata_dirs, store=self.state_store)
+        return self._raw_index
+
+
+    def refresh_raw_index(self):
+        self.raw_index.refresh()
+        return
+
+
+    @property
+    def jobs(self):
+        """
+        Snapshot of our RUNNING/PENDING SLURM jobs, shared through a cache
+        file in the results_dir for `job_snapshot_ttl` seconds [slurm
+        config, default 60]
+        """
+        if self._jobs is None:
+            self._jobs = JobSnapshot(ttl=self.slurm_config.get('job_snapshot_ttl', 60),
+                                     cache_path=pjoin(self.results_dir, 'x2p.jobs.json'),
+                                     source=self.slurm_config.get('job_source', 'sacct'))
+        return self._jobs
+
+
+    @property
+    def array_dir(self):
+        """
+        Where job-array scripts, manifests and logs are kept
+        """
+        return pjoin(self.results_dir, '{}.x2p.arrays'.format(self.name))
+
+
+    def submit_array(self, pipeline, rows, make_script, debug=False, failed=None):
+        """
+        Submit one SLURM job array per `array_max_size` rows [slurm config,
+        default 1000], with at most `array_max_running` tasks running at
+        once [slurm config, default no limit]. Each task counts towards
+        `max_pending`, rows beyond it are held back (see submit_scripts).
+
+        make_script(manifest_path) returns the batch script; task i
+        reads line i of the manifest. Returns a SubmitResult keyed by
+        (metadata, run), with the job id of each task, '<array job id>_<i>';
+        `failed` are {(metadata, run) : error} from preparing the rows.
+        """
+
+        result = SubmitResult()
+        result.failed.update(failed or {})
+
+        max_pending = self.slurm_config.get('max_pending', None)
+        if max_pending is not None:
+            n_free = max(max_pending - self.pending_jobs(pipeline), 0)
+            result.held.extend([ (row['metadata'], row['run']) for row in rows[n_free:] ])
+            rows = rows[:n_free]
+
+        if not os.path.exists(self.array_dir):
+            os.makedirs(self.array_dir)
+        self.clean_array_dir()
+
+        max_size    = self.slurm_config.get('array_max_size', 1000)
+        max_running = self.slurm_config.get('array_max_running', None)
+
+        chunks, scripts, extra_args = {}, [], {}
+        for start in range(0, len(rows), max_size):
+            chunk = rows[start:start+max_size]
+
+            stamp = '{}{}-{}-{}-'.format(pipeline, ARRAY_NAME,
+                                         time.strftime('%Y%m%d-%H%M%S'), start)
+            fd, manifest = tempfile.mkstemp(prefix=stamp, suffix='.manifest',
+                                            dir=self.array_dir)
+            os.close(fd)
+            write_manifest(manifest, chunk)
+
+            # sbatch keeps its own copy of the script
+            fd, slurm_file = tempfile.mkstemp(prefix=stamp, suffix='.sh',
+                                              dir=self.array_dir)
+            with os.fdopen(fd, 'w') as f:
+                f.write(make_script(manifest))
+
+            array = '0-{}'.format(len(chunk) - 1)
+            if max_running:
+                array += '%{}'.format(max_running)
+
+            if debug:
+                print('-->', slurm_file, '--array={}'.format(array))
+                continue
+
+            chunks[start] = (manifest, chunk)
+            scripts.append( (start, slurm_file) )
+            extra_args[start] = ['--array={}'.format(array)]
+
+        submitter = self._submitter(max_pending=None) # capped above, per task
+        arrays    = submitter.submit(scripts, extra_args=extra_args)
+
+        for start, (manifest, chunk) in chunks.items():
+
+            if start not in arrays.submitted:
+                os.remove(manifest)
+                for row in chunk:
+                    result.failed[(row['metadata'], row['run'])] = arrays.failed[start]
+                continue
+
+            job_id = arrays.submitted[start]
+
+            # running-job detection finds the manifest by array job id
+            link = pjoin(self.array_dir, '{}.tsv'.format(job_id))
+            tmp  = '{}.{}'.format(link, os.getpid())
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            os.symlink(os.path.basename(manifest), tmp)
+            os.replace(tmp, link)
+
+            for i, row in enumerate(chunk):
+                result.submitted[(row['metadata'], row['run'])] = '{}_{}'.format(job_id, i)
+
+        result.report()
+
+        return result
+
+
+    def clean_array_dir(self):
+        """
+        Remove the manifests, job id links and logs in array_dir that are
+        older than `array_keep_days` [slurm config, default history_days
+        or 14] and not used by a job still in the queue. Manifests are
+        kept that long since update_job_history() reads them too.
+        """
+
+        days   = self.slurm_config.get('array_keep_days',
+                                       self.slurm_config.get('history_days', 14))
+        cutoff = time.time() - days * 86400
+
+        active = set([ array_tasks(job.job_id)[0] for job in self.jobs.jobs ])
+        id_ptn = re.compile(r'(?:^|-)(\d+)(?:_\d+)?\.(?:tsv|out)$')
+
+        entries = _scandir(self.array_dir)
+        in_use  = set()
+        for entry in entries:
+            g = id_ptn.search(entry.name)
+            if g and (g.groups()[0] in active) and entry.is_symlink():
+                in_use.add(os.readlink(entry.path))
+
+        for entry in entries:
+            g = id_ptn.search(entry.name)
+            if (g and g.groups()[0] in active) or (entry.name in in_use):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+        return
+
+
+    def pending_jobs(self, pipeline):
+        """
+        The number of this pipeline's jobs (array tasks included) PENDING
+        """
+        return len([ job for job in self.jobs.index(pipeline, manifest_dir=self.array_dir).values()
+                     if job.state == 'PENDING' ])
+
+
+    def _submitter(self, max_pending=None, pending=0):
+        return Submitter(concurrency=self.slurm_config.get('submit_concurrency', 4),
+                         max_pending=max_pending,
+                         pending=pending,
+                         timeout=self.slurm_config.get('sbatch_timeout', 60))
+
+
+    def prepare_jobs(self, mds, prepare):
+        """
+        Return [(md, prepare(*md)), ...] and {md : error} for the mds
+        that could not be prepared, e.g. because a value is missing from
+        the database; one bad dataset does not stop the others.
+        """
+
+        prepared = []
+        failed   = {}
+        for md in mds:
+            try:
+                prepared.append( (md, prepare(*md)) )
+            except (ResolutionError, OSError, RuntimeError, ValueError) as e:
+                failed[md] = '{}: {}'.format(type(e).__name__, e)
+
+        return prepared, failed
+
+
+    def submit_scripts(self, pipeline, scripts, failed=None):
+        """
+        Submit [((metadata, run), script_path), ...] concurrently, at most
+        `submit_concurrency` sbatch calls at once [slurm config, default 4],
+        holding back new jobs once `max_pending` of this pipeline's jobs
+        are pending [slurm config, default no cap]. Failures are reported,
+        not raised, together with `failed`, {(metadata, run) : error} from
+        writing the scripts. Returns a SubmitResult.
+        """
+
+        max_pending = self.slurm_config.get('max_pending', None)
+        pending     = self.pending_jobs(pipeline) if max_pending is not None else 0
+
+        result = self._submitter(max_pending=max_pending, pending=pending).submit(scripts)
+        result.failed.update(failed or {})
+        result.report()
+
+        return result
+
+
+    def reduction_features(self):
+        """
+        Return {(metadata, run) : (resolution_cc, space_group)} for our
+        reductions in the database, from one query
+        """
+
+        if self._reduction_features is None:
+            query = ("SELECT D.metadata, R.run_id, R.resolution_cc, R.space_group "
+                     "FROM {}.Data_Reduction AS R "
+                     "INNER JOIN SARS_COV_2_v2.Diffractions AS D "
+                     "ON R.crystal_id = D.crystal_id AND R.run_id = D.run_id "
+                     "WHERE R.method = %s"
+                     "".format(self._analysis_db))
+            cursor = self.db.execute(query, (self.reduction_pipeline_name,))
+            rows = cursor.fetchall()
+            cursor.close()
+
+            self._reduction_features = { (r['metadata'], r['run_id']) :
+                                         (r['resolution_cc'], r['space_group'])
+                                         for r in rows }
+
+        return self._reduction_features
+
+
+    def job_features(self, metadata, run):
+        """
+        Return the full frame count, resolution and space group of a
+        dataset, each None if not known or not in `submit_features`
+        """
+
+        features = {'frames' : self.raw_index.total_frames(metadata, run)}
+
+        if ('resolution' in self.submit_features) or ('space_group' in self.submit_features):
+            features['resolution'], features['space_group'] = \
+                self.reduction_features().get((metadata, run), (None, None))
+
+        return { k : (features.get(k) if k in self.submit_features else None)
+                 for k in ['frames', 'resolution', 'space_group'] }
+
+
+    def update_job_history(self, pipeline):
+        """
+        Add the jobs of `pipeline` (a job name prefix) that completed in
+        the last `history_days` [slurm config, default 14] to the job
+        history, and return the whole history
+        """
+
+        if self.state_store:
+            history = self.state_store.load_job_history(pipeline)
+        else:
+            history = []
+        known = set([ h['job_id'] for h in history ])
+
+        days = self.slurm_config.get('history_days', 14)
+        new  = []
+        for (metadata, run), job in match_jobs(completed_jobs(days), pipeline,
+                                               manifest_dir=self.array_dir):
+            if job.job_id in known:
+                continue
+            record = {'job_id'   : job.job_id,
+                      'metadata' : metadata,
+                      'run'      : run,
+                      'elapsed'  : job.elapsed,
+                      'cpus'     : job.cpus,
+                      'cpu_time' : job.cpu_time,
+                      'max_rss'  : job.max_rss}
+            record.update(self.job_features(metadata, run))
+            new.append(record)
+            known.add(job.job_id)
+
+        if self.state_store and len(new) > 0:
+            self.state_store.add_job_history(pipeline, new)
+
+        return history + new
+
+
+    def resource_model(self, pipeline):
+        """
+        The ResourceModel for the jobs of `pipeline`, or None unless
+        `adaptive_resources` is set [slurm config]
+        """
+
+        if not self.slurm_config.get('adaptive_resources', False):
+            return None
+
+        if pipeline not in self._resource_models:
+            try:
+                history = self.update_job_history(pipeline)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(' ! could not harvest job history: {}'.format(e))
+                history = self.state_store.load_job_history(pipeline) if self.state_store else []
+
+            self._resource_models[pipeline] = ResourceModel(history,
+                            min_samples=self.slurm_config.get('min_history', 20),
+                            max_cores=self.slurm_config.get('max_cores', 32))
+
+        return self._resource_models[pipeline]
+
+
+    def job_resources(self, pipeline, metadata, run, resolution=None):
+        """
+        Return the predicted {'cores', 'mem_mb', 'time'} of a job, or None
+        to keep the default request
+        """
+
+        model = self.resource_model(pipeline)
+        if model is None:
+            return None
+
+        features = self.job_features(metadata, run)
+        if resolution is not None:
+            features['resolution'] = resolution
+
+        return model.predict(**features)
+
+
+    def resource_request(self, resources, nproc, cores=None, mem=None, walltime=None):
+        """
+        Return (nproc, #SBATCH lines) for a batch script. With a
+        job_resources() prediction its cores (also used as nproc), memory
+        and walltime are requested; without, the defaults given here,
+        each left to SLURM if None. Cores are capped at `max_cores`
+        [slurm config, default 32].
+        """
+
+        if resources is not None:
+            nproc    = cores = resources['cores']
+            mem      = '{}M'.format(resources['mem_mb'])
+            walltime = resources['time']
+
+        max_cores = self.slurm_config.get('max_cores', 32)
+        nproc = min(nproc, max_cores)
+        if cores is not None:
+            cores = min(cores, max_cores)
+
+        lines = []
+        for option, value in [('cpus-per-task', cores), ('mem', mem), ('time', walltime)]:
+            if value is not None:
+                lines.append('#SBATCH --{}={}'.format(option, value))
+
+        return nproc, '\n'.join(lines)
+
+
+    def _parse(self, parser, path):
+        """
+        Return parser(path), memoised on disk by (path, size, mtime)
+        """
+        if self.parse_memo is None:
+            return parser(path)
+        return self.parse_memo.call(parser, path)
+
+
+    def _probe_width(self, fn):
+        # after scan_results() the result checks are in-memory lookups,
+        # a thread pool would only add overhead
+        if (self.results_index is not None) and (fn in [self.xia_result, self.dmpl_result]):
+            return 1
+        return self.probe_threads
+
+
+    def probe(self, fn, mds):
+        """
+        Return [fn(*md) for md in mds], run on a pool of `probe_threads`
+        threads if fn hits the filesystem, in order
+        """
+        return probe_map(fn, mds, width=self._probe_width(fn))
+
+
+    def probe_filter(self, fn, mds, keep=bool):
+        """
+        Lazily yield the md in mds for which keep(fn(*md)), checked on
+        the pool of `probe_threads` threads if fn hits the filesystem
+        """
+        return probe_filter(fn, mds, keep=keep, width=self._probe_width(fn))
+
+
+    def priority_fields(self, mds):
+        """
+        Return {(metadata, run) : {mtime, resolution_cc, target}} with
+        the fields the scheduler uses, each from one in-memory index or
+        one query
+        """
+
+        needs  = self.scheduler.needs
+        fields = { tuple(md) : {} for md in mds }
+
+        if 'mtime' in needs:
+            for md, f in fields.items():
+                datasets = self.raw_index.lookup(*md)
+                if len(datasets) > 0:
+                    f['mtime'] = datasets[0].dir_mtime
+
+        if 'resolution_cc' in needs:
+            query = ("SELECT D.metadata, R.run_id, R.method, R.resolution_cc "
+                     "FROM {}.Data_Reduction AS R "
+                     "INNER JOIN SARS_COV_2_v2.Diffractions AS D "
+                     "ON R.crystal_id = D.crystal_id AND R.run_id = D.run_id"
+                     "".format(self._analysis_db))
+            cursor = self.db.execute(query)
+            rows = cursor.fetchall()
+            cursor.close()
+
+            # our own reduction if there is one, else the best of the others
+            own = {}
+            best = {}
+            for r in rows:
+                md, res = (r['metadata'], r['run_id']), r['resolution_cc']
+                if (md not in fields) or (res is None):
+                    continue
+                if r['method'] == self.reduction_pipeline_name:
+                    own[md] = res
+                best[md] = min(res, best.get(md, res))
+            for md, f in fields.items():
+                if md in own or md in best:
+                    f['resolution_cc'] = own.get(md, best.get(md))
+
+        if 'target' in needs:
+            rows = self.db.select_iter(['metadata', 'run_id', 'target_id'],
+                                       'SARS_COV_2_v2.Crystal_View',
+                                       {'diffraction' : 'Success'},
+                                       row_type='tuple')
+            for metadata, run, target in rows:
+                if (metadata, run) in fields:
+                    fields[(metadata, run)]['target'] = target
+
+        return fields
+
+
+    def rank_candidates(self, mds):
+        """
+        Return (mds in submission order, their priority fields); without
+        a scheduler the order is unchanged and the fields are None
+        """
+        mds = list(mds)
+        if self.scheduler is None:
+            return mds, None
+        fields = self.priority_fields(mds)
+        return self.scheduler.rank(mds, fields), fields
+
+
+    def apply_quotas(self, mds, fields):
+        """
+        Lazily drop the datasets beyond their target's per-cycle quota
+        """
+        if self.scheduler is None:
+            return iter(mds)
+        return self.scheduler.apply_quotas(mds, fields)
+
+
     def metadata_to_id(self, metadata, run):
-        cid = self.db.select('crystal_id',
-                             'SARS_COV_2_v2.Diffractions',
-                             {'metadata' : metadata, 'run_id' : run},
-                             )
-        if len(cid) == 0:
-            raise IOError('no crystal_id in database for '
-                          'metadata={}, run={}'.format(metadata, run))
-        if len( set([ x['crystal_id'] for x in cid ]) ) > 1: # check unique
-            #print('multiple cid for metadata/run: {}/{}'. format(metadata, run), cid)
-            raise IOError('found multiple irreconcilable crystal_id`s in db for '
-                          'metadata={}, run={}'.format(metadata, run))
-        return cid[0]['crystal_id']
+        return self.diffractions.metadata_to_id(metadata, run)
 
 
     def id_to_metadata(self, crystal_id, run):
-        md = self.db.select('metadata',
-                            'SARS_COV_2_v2.Diffractions',
-                            {'crystal_id' : crystal_id, 'run_id' : run})
-        return get_single(md, crystal_id, run, 'metadata')
+        return self.diffractions.id_to_metadata(crystal_id, run)
 
 
     def get_reduction_id(self, crystal_id, run):
@@ -257,19 +856,15 @@ class ProjectBase:
         Specifically, this function returns the entire path to e.g. cbf files
         not a generic dataset directory.
 
-        Repeated database queries are going slowly at the moment, so you
-        can switch that off with skip_db=True.
+        The database pattern is served from the in-memory Diffractions
+        index; skip_db=True ignores it and searches the disk only.
         """
 
         # >> try to use the database
         if not skip_db:
 
             crystal_id = self.metadata_to_id(metadata, run)
-
-            dp_qry = self.db.select('data_raw_filename_pattern',
-                                    'SARS_COV_2_v2.Diffractions',
-                                    {'crystal_id' : crystal_id, 'run_id' : run})
-            data_pattern = get_single(dp_qry, crystal_id, run, 'data_raw_filename_pattern')
+            data_pattern = self.diffractions.data_pattern(crystal_id, run)
 
         else:
             data_pattern = None
@@ -279,50 +874,94 @@ class ProjectBase:
             dataset_path = os.path.dirname(data_pattern)
             ext          = os.path.basename(data_pattern).split('.')[-1]
 
-        # >> but if that fails, fall back on searching directories
+        # >> but if that fails, fall back on the raw data index
         else: # data_pattern is None        
 
-            possible_dirs = []
-            for rawdata_dir in self.rawdata_dirs:
-                dataset_path = pjoin(rawdata_dir,
-                                     "{}/{}_{:03d}".format(metadata, metadata, run))
-                #print('xxx', os.path.exists(dataset_path), dataset_path)
-                if os.path.exists(dataset_path):
-                    possible_dirs.append(dataset_path)
+            possible_dirs = self.raw_index.lookup(metadata, run)
 
             if len(possible_dirs) == 0:
                 raise IOError('cannot find data for {}_{:03d}'.format(metadata, run))
             elif len(possible_dirs) > 1:
-                dataset_path = possible_dirs[0]
                 print(' ! warning ! found >1 data directory for:')
                 print('{}_{:03d}'.format(metadata, run))
-                print('using first: {}'.format(rawdir))
-            else:
-                dataset_path = possible_dirs[0]
-                ext = '.cbf' # TODO be smarter
+                print('using first: {}'.format(possible_dirs[0].path))
+
+            dataset_path = possible_dirs[0].path
+            ext          = possible_dirs[0].ext
 
         return dataset_path, ext
 
 
     def raw_data_exists(self, metadata, run, min_files=999):
 
+        # datasets we recently failed to find are not searched again
+        # until their backoff interval has passed
+        until = self.missing_until(metadata, run)
+        if (until is not None) and (time.time() < until):
+            return False
+
         try:
             dataset_path, ext = self.metadata_to_dataset_path(metadata, run)
         except IOError as e:
             #print(e)
+            self._mark_missing(metadata, run)
             return False # for now assume data do not exist
 
-        pth = dataset_path + "/*{}".format(ext)
-        n_files = len(glob(pth))
+        # streams the listing, stops at min_files and remembers
+        # datasets that are complete, so they are never listed again
+        data_exists = self.raw_index.has_frames(dataset_path, ext, min_files)
 
-        if n_files > min_files:
-            data_exists = True
-        else:
-            data_exists = False
+        # a collection in progress has a directory, no directory = missing
+        if not data_exists and not os.path.isdir(dataset_path):
+            self._mark_missing(metadata, run)
+        elif data_exists and (until is not None):
+            with self._missing_lock:
+                self._missing_found.add( (metadata, run) )
 
         return data_exists
 
 
+    def load_missing(self):
+        """
+        Load the negative cache of datasets without raw data from the
+        state store, once per cycle; see save_missing()
+        """
+        with self._missing_lock:
+            if self.state_store:
+                self._missing = self.state_store.load_missing()
+            else:
+                self._missing = {}
+        return
+
+
+    def missing_until(self, metadata, run):
+        if self._missing is None:
+            self.load_missing()
+        return self._missing.get( (metadata, run), None )
+
+
+    def _mark_missing(self, metadata, run):
+        with self._missing_lock:
+            self._missing_new.add( (metadata, run) )
+        return
+
+
+    def save_missing(self):
+        """
+        Write the datasets found missing or found again this cycle to
+        the state store, in one transaction
+        """
+        with self._missing_lock:
+            missing, self._missing_new   = self._missing_new, set()
+            found,   self._missing_found = self._missing_found, set()
+            self._missing = None
+        if self.state_store and (missing or found):
+            self.state_store.update_missing(missing, found,
+                                            self.missing_recheck,
+                                            self.missing_recheck_max)
+        return
+
+
     def metadata_to_outdir(self, metadata, run):
         s = pjoin(self.results_dir, 
                   "{}/{}/{}_{:03d}".format(self.name, 
@@ -332,8 +971,22 @@ class ProjectBase:
         return s
 
 
+    def scan_results(self):
+        """
+        Walk the results tree once; until the next scan, xia_result and
+        dmpl_result are answered from this snapshot without touching
+        the filesystem.
+        """
+        self.results_index = ResultsIndex(self.results_dir, self.name,
+                                          store=self.state_store)
+        return
+
+
     def xia_result(self, metadata, run):
 
+        if self.results_index is not None:
+            return self.results_index.xia_result(metadata, run)
+
         # check for something like this:
         # / ... /DIALS/l8p23_03/l8p23_03_001/DataFiles/<...>.mtz
         # / ... /DIALS/l8p23_03/l8p23_03_001/<...>.error
@@ -361,44 +1014,16 @@ class ProjectBase:
 
         outdir = self.metadata_to_outdir(metadata, run)
 
-        json_path = pjoin(outdir, 
-                          '{}_{:03d}'.format(metadata, run), 
-                          'scale/xia2.json')
-
-        if not os.path.exists(json_path):
-
-            # there were a few old datasets processed with just
-            # the meadata field, so try and find those -- if 
-            # that fails, we fail completely
-            orig_json_path = json_path
-            json_path = pjoin(outdir, 
-                              '{}'.format(metadata), 
-                              'scale/xia2.json')
-
-            if not os.path.exists(json_path):
-                raise IOError('cannot find DIALS json for '
-                              '{}_{:03d}'.format(metadata, run))
-
+        json_path = find_xia2_json(outdir, metadata, run)
 
         # >>> parse the DIALS json
-        root = json.load(open(json_path, 'r'))
+        # cell = [a, b, c, alpha, beta, gamma], ss = overall statistics
+        # only these values are decoded, not the whole (large) file
+        cell, space_group, ss = self._parse(read_xia2_json, json_path)
 
         mtz_path = pjoin(outdir,
                          "DataFiles/SARSCOV2_{}_{:03d}_free.mtz".format(metadata, run))
 
-        # here, cell = [a, b, c, alpha, beta, gamma]
-        cell = root['_scalr_cell']
-
-        # this one has some strange float-like key, but there is only one
-        k = list(root['_scalr_integraters'])[0]
-        space_group = root['_scalr_integraters'][k]['_intgr_spacegroup_number']
-
-        # these are keyed by something nasty like '["SARSCOV2", "l6p17_10", "NATIVE"]'
-        # but we expect just one sub-directory, so grab that...
-        # we want the first entry, which is the entire resolution range
-        # the other two are low & high res reflections only
-        ss = list(root['_scalr_statistics'].values())[0]
-
         # >>> format the output
         data_dict = {
                     'crystal_id' :   self.metadata_to_id(metadata, run),
@@ -434,44 +1059,54 @@ class ProjectBase:
     def fetch_reduction_successes(self, in_db=False):
 
         if not in_db: # on disk
-            successes = self.db.select('metadata, run_id',
-                                       'SARS_COV_2_v2.Diffractions',
-                                       {'diffraction' : 'Success'},)
+            successes = self.db.select_iter(['metadata', 'run_id'],
+                                            'SARS_COV_2_v2.Diffractions',
+                                            {'diffraction' : 'Success'},
+                                            row_type='tuple')
 
-            ret = []
-            for s in successes:
-                md = (s['metadata'], s['run_id'])
-                if self.xia_result(*md) == 'finished':
-                    ret.append(md)
+            ret = list(self.probe_filter(self.xia_result, successes,
+                                         keep=lambda r: r == 'finished'))
 
         else:
-            successes = self.db.select('crystal_id, run_id, mtz_path',
-                                       '{}.Data_Reduction'.format(self._analysis_db),
-                                       {'method' : self.reduction_pipeline_name})
-
-            ret = []
-            for s in successes:
-
-                ds_qry = self.db.select('diffraction',
-                                        'SARS_COV_2_v2.Diffractions',
-                                        {'crystal_id': s['crystal_id'],
-                                        'run_id':     s['run_id']}
-                                        )
-                diff = get_single(ds_qry, s['crystal_id'], s['run_id'], 'diffraction')
-
-                if diff == 'success' and os.path.exists(s['mtz_path']):
-                    ret.append( 
-                                (
-                                  self.id_to_metadata(s['crystal_id'], s['run_id']),
-                                  s['run_id']
-                                )
-                              )
+            rows = self.fetch_reduction_mtzs()
+
+            # stat all the mtz files in one pass after the query is done
+            exists = _paths_exist([ mtz_path for _, _, mtz_path in rows ],
+                                  width=self.probe_threads)
+
+            ret  = []
+            seen = set()
+            for md, run, mtz_path in rows:
+                if exists[mtz_path] and (md, run) not in seen:
+                    ret.append( (md, run) )
+                    seen.add( (md, run) )
                 #else:
-                #    print('cannot find reduction mtz or no diffraction:', s, diff)
+                #    print('cannot find reduction mtz or no diffraction:', md, run)
 
         return ret
 
 
+    def fetch_reduction_mtzs(self):
+        """
+        Return (metadata, run_id, mtz_path) for every reduction by the
+        current pipeline of a successfully diffracting crystal, using a
+        single JOIN against the Diffractions table.
+        """
+
+        query = ("SELECT D.metadata, R.run_id, R.mtz_path "
+                 "FROM {}.Data_Reduction AS R "
+                 "INNER JOIN SARS_COV_2_v2.Diffractions AS D "
+                 "ON R.crystal_id = D.crystal_id AND R.run_id = D.run_id "
+                 "WHERE R.method = %s AND D.diffraction = 'success'"
+                 "".format(self._analysis_db))
+
+        cursor = self.db.execute(query, (self.reduction_pipeline_name,))
+        rows = cursor.fetchall()
+        cursor.close()
+
+        return [ (r['metadata'], r['run_id'], r['mtz_path']) for r in rows ]
+
+
     def get_reduction_res(self, metadata, run):
 
         # this function is here to allow later modification of,
@@ -534,6 +1169,9 @@ class ProjectBase:
 
     def dmpl_result(self, metadata, run):
 
+        if self.results_index is not None:
+            return self.results_index.dmpl_result(metadata, run)
+
         outdir = self.metadata_to_outdir(metadata, run)
 
         mtzpth = "{}_{:03d}_003.mtz".format(metadata, run)
@@ -558,7 +1196,7 @@ class ProjectBase:
 
         # locate the initial pdb
         dimple1_log_path = pjoin(outdir, 'dimple.log')
-        initial_pdb = _get_pdb_chosen_by_dimple(dimple1_log_path)
+        initial_pdb = self._parse(_get_pdb_chosen_by_dimple, dimple1_log_path)
 
         initial_pdb_path = None
         for path in list(self.refinement_config.get('reference_pdb', [])):
@@ -566,45 +1204,28 @@ class ProjectBase:
                 initial_pdb_path = path
 
 
-        def stats_from_log(log_path):
-            # from log: r-work r-free bonds angles b_min b_max b_ave
-            p = 'end\:' + '\s+(\d+\.\d+)'*7
-            with open(log_path, 'r') as f:
-                g = re.search(p, f.read())
-
-            if g is None:
-                raise IOError('Could not parse: {}'.format(log_path))
-            else:
-                log_results = [ float(e) for e in g.groups() ]
-
-            return log_results
-
-
         # cycle through the pdbs produced by phenix, choose best r_free
-        r_frees = []
+        # each log is read once, from the end, for all seven values
+        stats = {}
         for serial in [1,2,3]:
-
             log_path = pjoin(outdir, "{}_{:03d}_{:03d}.log".format(metadata, run, serial))
+            try:
+                stats[serial] = self._parse(_phenix_log_stats, log_path)
+            except OSError as e:
+                # this happens rarely when one phenix serial step fails
+                # but the next one proceeds OK (or the log is missing)
+                #print(e)
+                stats[serial] = None
 
-            if os.path.exists(log_path):
-                try:
-                    _, r_free, _, _, _, _, _ = stats_from_log(log_path)
-                    r_frees.append(r_free)
-                except OSError as e:
-                    # this happens rarely when one phenix serial step fails
-                    # but the next one proceeds OK
-                    #print(e)
-                    r_frees.append(1.0)
-            else:
-                r_frees.append(1.0)
+        r_frees = [ stats[s][1] if stats[s] else 1.0 for s in [1,2,3] ]
 
         # (remember serial is 1-indexed)
         best_serial = argmin(r_frees) + 1
-        if r_frees[best_serial-1] == None:
-            raise RuntimeError('cannot find valid phenix log for {}_{:03d}'.format(metadata, run))
-
         log_path = pjoin(outdir, "{}_{:03d}_{:03d}.log".format(metadata, run, best_serial))
-        log_results = stats_from_log(log_path)
+
+        log_results = stats[best_serial]
+        if log_results is None:
+            raise IOError('cannot find valid phenix log for {}_{:03d}'.format(metadata, run))
 
         mtz_name = "{}_{:03d}_{:03d}.mtz".format(metadata, run, best_serial)
         mtz_path = pjoin(outdir, mtz_name)
@@ -665,15 +1286,7 @@ class ProjectBase:
             raise IOError('{}_{:03d}/dimple.log does not exist'
                           ''.format(metadata, run))
 
-        # it turns out the python config parser handles dimple.log
-        with open(log_path, 'r') as f:
-            txt = f.read()
-            free_g = re.search('free_r: (\d+\.\d+)', txt)
-            work_g = re.search('overall_r: (\d+\.\d+)', txt)
-
-        if not (free_g or work_g):
-            print(free_g, work_g)
-            raise IOError('cannot parse: {}'.format(log_path))
+        rfree, rwork = self._parse(_dimple_r_factors, log_path)
 
         data_dict = {
                      'data_reduction_id':    self.get_reduction_id(cid, run),
@@ -684,12 +1297,12 @@ class ProjectBase:
                      'refinement_mtz_path':  mtz_path,
                      'method':               'dmpl-dimple',
                      'resolution_cut':       self.get_reduction_res(metadata, run),
-                     'rfree':                float(free_g.groups()[0]),
-                     'rwork':                float(work_g.groups()[0]),
+                     'rfree':                rfree,
+                     'rwork':                rwork,
                      #'rms_bond_length':      fmt(log['refmac5 restr']['rmsbond']),
                      #'rms_bond_angle':       fmt(log['refmac5 restr']['rmsangl']),
                      #'num_blobs':            _count_blobs(log),
-                     'average_model_b':      _get_average_model_b(pdb_path),
+                     'average_model_b':      self._parse(_get_average_model_b, pdb_path),
                     }
         
         return data_dict
@@ -697,14 +1310,13 @@ class ProjectBase:
 
     def fetch_dmpl_successes(self):
 
-        successes = self.db.select('metadata, run_id',
-                                   'SARS_COV_2_v2.Diffractions',
-                                   {'diffraction' : 'Success'},)
+        successes = self.db.select_iter(['metadata', 'run_id'],
+                                        'SARS_COV_2_v2.Diffractions',
+                                        {'diffraction' : 'Success'},
+                                        row_type='tuple')
 
-        to_run = []
-        for md in [ (s['metadata'], s['run_id']) for s in successes ]:
-            if self.dmpl_result(*md) == 'finished':
-                to_run.append(md)
+        to_run = list(self.probe_filter(self.dmpl_result, successes,
+                                        keep=lambda r: r == 'finished'))
 
         return to_run
 
@@ -0,0 +1,268 @@
+"""
+Index of the raw diffraction data found under the rawdata_dirs
+"""
+
+import os
+import re
+
+from xia2pipe.resultscan import _scandir
+
+
+class RawDataset:
+    """
+    One raw dataset directory, <rawdata_dir>/<metadata>/<metadata>_<run>
+
+      counts    : {extension : number of files}, e.g. {'cbf' : 1800}
+      dir_mtime : mtime of the dataset directory when it was counted
+    """
+
+    __slots__ = ['path', 'metadata', 'run', 'counts', 'dir_mtime']
+
+    def __init__(self, path, metadata, run, counts, dir_mtime):
+        self.path      = path
+        self.metadata  = metadata
+        self.run       = run
+        self.counts    = counts
+        self.dir_mtime = dir_mtime
+        return
+
+
+    @property
+    def ext(self):
+        """
+        The most common file extension, with a leading dot
+        """
+        if not self.counts:
+            return '.cbf'
+        return '.' + max(self.counts, key=self.counts.get)
+
+
+    def n_frames(self, ext=None):
+        if ext is None:
+            ext = self.ext
+        return self.counts.get(ext.lstrip('.'), 0)
+
+
+def count_frames(path, ext, stop_after=None):
+    """
+    Count the files in path ending with ext (like glob path/*ext),
+    streaming the listing and stopping as soon as more than
+    stop_after have been seen
+    """
+
+    n_files = 0
+
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.endswith(ext) and not entry.name.startswith('.'):
+                    n_files += 1
+                    if (stop_after is not None) and (n_files > stop_after):
+                        break
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+
+    return n_files
+
+
+class RawDataIndex:
+    """
+    Enumerates each rawdata_dir (two levels of os.scandir) and records
+    the path, extension and frame count of every dataset.
+
+    refresh() is incremental: a <metadata> directory is only listed
+    again if its mtime changed, and a dataset's frames are only
+    re-counted if the dataset directory mtime changed. With a
+    StateStore, the index persists between runs.
+
+    Frame counting stops once more than `min_frames` frames are seen;
+    such datasets are marked complete (a finished collection does not
+    change) and are never listed again. total_frames() gives the full
+    count of a dataset, when it is needed.
+    """
+
+    def __init__(self, rawdata_dirs, store=None, min_frames=999):
+
+        self.rawdata_dirs = [ os.path.normpath(d) for d in rawdata_dirs ]
+        self.store        = store
+        self.min_frames   = min_frames
+
+        self._datasets = {} # path --> RawDataset
+        self._md_dirs  = {} # <rawdata_dir>/<metadata> --> (mtime, [dataset paths])
+
+        # dataset paths known to hold > min_frames frames
+        self.complete = set()
+
+        # full, uncapped frame counts, path --> (dir mtime, frames)
+        self._totals = {}
+
+        if self.store:
+            self._datasets, self._md_dirs = self.store.load_raw()
+            self.complete = self.store.load_complete(self.min_frames)
+            self._totals  = self.store.load_frame_totals()
+
+        self.refresh()
+
+        return
+
+
+    def has_frames(self, path, ext, min_files):
+        """
+        True if path holds more than min_files files ending with ext
+        """
+
+        path = os.path.normpath(path)
+
+        if (path in self.complete) and (min_files <= self.min_frames):
+            return True
+
+        # the index counts are capped at min_frames + 1, fine to use here
+        ds = self._datasets.get(path)
+        if (ds is not None) and (min_files <= self.min_frames):
+            n_files = ds.n_frames(ext)
+        else:
+            n_files = count_frames(path, ext, stop_after=min_files)
+
+        if n_files > min_files >= self.min_frames:
+            self.complete.add(path)
+            if self.store:
+                self.store.add_complete([path], self.min_frames)
+
+        return n_files > min_files
+
+
+    def refresh(self):
+
+        datasets = {}
+        md_dirs  = {}
+
+        for rawdata_dir in self.rawdata_dirs:
+            for md_entry in _scandir(rawdata_dir):
+                if not md_entry.is_dir():
+                    continue
+
+                md_mtime = md_entry.stat().st_mtime
+                old = self._md_dirs.get(md_entry.path)
+
+                if old and old[0] == md_mtime:
+                    ds_paths = old[1]
+                else:
+                    ds_paths = self._list_md_dir(md_entry.path, md_entry.name)
+
+                md_dirs[md_entry.path] = (md_mtime, ds_paths)
+
+                for path in ds_paths:
+                    if (path in self.complete) and (path in self._datasets):
+                        datasets[path] = self._datasets[path]
+                        continue
+                    ds = self._update_dataset(path, md_entry.name)
+                    if ds is not None:
+                        datasets[path] = ds
+
+        changed = [ ds for path, ds in datasets.items()
+                    if self._datasets.get(path) is not ds ]
+        removed = set(self._datasets.keys()) - set(datasets.keys())
+
+        self._datasets = datasets
+        self._md_dirs  = md_dirs
+
+        newly_complete = [ ds.path for ds in changed
+                           if ds.n_frames() > self.min_frames ]
+        self.complete.update(newly_complete)
+
+        if self.store:
+            self.store.save_raw(changed, removed, md_dirs)
+            self.store.add_complete(newly_complete, self.min_frames)
+
+        return
+
+
+    def _list_md_dir(self, md_path, metadata):
+        run_ptn = re.compile(re.escape(metadata) + r'_(\d+)$')
+        return [ e.path for e in _scandir(md_path)
+                 if run_ptn.match(e.name) and e.is_dir() ]
+
+
+    def _update_dataset(self, path, metadata):
+        """
+        Return the (possibly re-counted) RawDataset at path, or None if
+        the directory has gone
+        """
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+
+        old = self._datasets.get(path)
+        if old and old.dir_mtime == mtime:
+            return old
+
+        # stream the listing, stop once the dataset is clearly complete
+        counts = {}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    ext = entry.name.split('.')[-1]
+                    counts[ext] = counts.get(ext, 0) + 1
+                    if counts[ext] > self.min_frames:
+                        break
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        run = int(os.path.basename(path)[len(metadata)+1:])
+
+        return RawDataset(path, metadata, run, counts, mtime)
+
+
+    def total_frames(self, metadata, run):
+        """
+        The full frame count of (metadata, run), or None without raw data.
+        Unlike the index counts it is not capped at min_frames, so it
+        takes a complete listing; that is done once per dataset
+        directory mtime and kept in the store. The mtime is stat'ed
+        afresh, as the index keeps the first one of complete datasets.
+        """
+
+        datasets = self.lookup(metadata, run)
+        if len(datasets) == 0:
+            return None
+        ds = datasets[0]
+
+        try:
+            mtime = os.stat(ds.path).st_mtime
+        except FileNotFoundError:
+            return None
+
+        cached = self._totals.get(ds.path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        frames = count_frames(ds.path, ds.ext)
+        self._totals[ds.path] = (mtime, frames)
+        if self.store:
+            self.store.add_frame_totals([ (ds.path, mtime, frames) ])
+
+        return frames
+
+
+    def __len__(self):
+        return len(self._datasets)
+
+
+    def get(self, path):
+        """
+        Return the RawDataset for a dataset directory path, or None
+        """
+        return self._datasets.get(os.path.normpath(path), None)
+
+
+    def lookup(self, metadata, run):
+        """
+        Return the RawDatasets for (metadata, run), in rawdata_dirs order
+        """
+        paths = [ os.path.join(rawdata_dir, metadata,
+                               '{}_{:03d}'.format(metadata, run))
+                  for rawdata_dir in self.rawdata_dirs ]
+        return [ self._datasets[p] for p in paths if p in self._datasets ]
+
@@ -0,0 +1,154 @@
+"""
+Resource requests predicted from the history of completed jobs
+"""
+
+import math
+import numpy as np
+
+from xia2pipe.slurmjobs import elapsed_to_seconds
+
+
+def sbatch_time(seconds):
+    """
+    Format seconds as a SLURM --time, [D-]HH:MM:SS
+    """
+    seconds = int(math.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+    h, seconds    = divmod(seconds, 3600)
+    m, s          = divmod(seconds, 60)
+    if days > 0:
+        return '{}-{:02d}:{:02d}:{:02d}'.format(days, h, m, s)
+    return '{:02d}:{:02d}:{:02d}'.format(h, m, s)
+
+
+class ResourceModel:
+    """
+    Predicts the cores, memory and walltime of a job from the history of
+    completed jobs of the same pipeline. Each history entry is a dict:
+
+        elapsed, cpu_time [s], cpus, max_rss [MB]    (from sacct)
+        frames, resolution [A], space_group          (None if unknown)
+
+    Walltime and memory are fit by least squares as linear in the frame
+    count and in 1/resolution**3 (~ the number of reflections), using
+    whichever of the two is known for the new job, then scaled by the
+    median ratio of actual to predicted for its space group. Cores are
+    the 90th percentile of the cores actually kept busy,
+    cpu_time / elapsed.
+
+    Predictions are padded by time_margin and mem_margin, since a job
+    that runs out of either is killed.
+    """
+
+    def __init__(self, history, min_samples=20, time_margin=1.5, mem_margin=1.3,
+                 max_cores=32, min_time=600, max_time=86400, min_mem=1024):
+
+        self.history     = [ h for h in history if h['elapsed'] > 0 ]
+        self.min_samples = min_samples
+        self.time_margin = time_margin
+        self.mem_margin  = mem_margin
+        self.max_cores   = max_cores
+        self.min_time    = min_time
+        self.max_time    = max_time
+        self.min_mem     = min_mem
+
+        self._fits = {} # (target, features) --> (features used, coef, records, y)
+
+        return
+
+
+    @property
+    def trained(self):
+        return len(self.history) >= self.min_samples
+
+
+    @staticmethod
+    def _row(features, frames, resolution):
+        values = {'frames' : frames,
+                  'inv_res3' : (1.0 / resolution**3) if resolution else None}
+        return [1.0] + [ values[f] for f in features ]
+
+
+    def _fit(self, target, features):
+        """
+        Least-squares fit of target (elapsed or max_rss) on features
+        """
+
+        key = (target, features)
+        if key in self._fits:
+            return self._fits[key]
+
+        records = [ h for h in self.history
+                    if None not in self._row(features, h.get('frames'), h.get('resolution')) ]
+
+        # too few records with these features, fit a constant
+        if len(records) < self.min_samples:
+            features = ()
+            records  = self.history
+
+        X = np.array([ self._row(features, h.get('frames'), h.get('resolution'))
+                       for h in records ], dtype=float)
+        y = np.array([ h[target] for h in records ], dtype=float)
+        coef = np.linalg.lstsq(X, y, rcond=None)[0]
+
+        self._fits[key] = (features, coef, records, y)
+        return self._fits[key]
+
+
+    def _predict(self, target, frames, resolution, space_group):
+
+        features = tuple([ f for f, v in [('frames', frames), ('inv_res3', resolution)] if v ])
+        features, coef, records, y = self._fit(target, features)
+
+        pred = float(np.dot(self._row(features, frames, resolution), coef))
+
+        # a fit can go below what any job needed, do not trust that
+        pred = max(pred, float(np.percentile(y, 10)))
+
+        if space_group is not None:
+            ratios = [ h[target] / max(float(np.dot(self._row(features, h.get('frames'),
+                                                              h.get('resolution')), coef)), 1e-6)
+                       for h in records if h.get('space_group') == space_group ]
+            if len(ratios) >= 5:
+                pred *= float(np.median(ratios))
+
+        return pred
+
+
+    def predict(self, frames=None, resolution=None, space_group=None):
+        """
+        Return {'cores' : int, 'mem_mb' : int, 'time' : '[D-]HH:MM:SS'},
+        or None if there is not enough history
+        """
+
+        if not self.trained:
+            return None
+
+        busy  = [ h['cpu_time'] / h['elapsed'] for h in self.history ]
+        cores = int(math.ceil(np.percentile(busy, 90) * 1.1))
+        cores = min(max(cores, 1), self.max_cores)
+
+        elapsed = self._predict('elapsed', frames, resolution, space_group)
+        elapsed = min(max(elapsed * self.time_margin, self.min_time), self.max_time)
+        elapsed = math.ceil(elapsed / 300.0) * 300 # whole 5 min
+
+        mem = self._predict('max_rss', frames, resolution, space_group)
+        mem = max(mem * self.mem_margin, self.min_mem)
+        mem = int(math.ceil(mem / 256.0) * 256)    # whole 256 MB
+
+        return {'cores' : cores, 'mem_mb' : mem, 'time' : sbatch_time(elapsed)}
+
+
+def largest(predictions):
+    """
+    The smallest request that fits all of predictions, e.g. for the tasks
+    of one job array; None if any of them is None
+    """
+
+    if (len(predictions) == 0) or any([ p is None for p in predictions ]):
+        return None
+
+    return {'cores'  : max([ p['cores'] for p in predictions ]),
+            'mem_mb' : max([ p['mem_mb'] for p in predictions ]),
+            'time'   : sbatch_time(max([ elapsed_to_seconds(p['time']) for p in predictions ]))}
+
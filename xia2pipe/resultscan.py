@@ -0,0 +1,179 @@
+"""
+Single-pass scan of a pipeline results tree
+"""
+
+import os
+import re
+from fnmatch import fnmatch
+
+
+class DatasetStatus:
+    """
+    What is on disk for one dataset output directory
+
+      xia_mtz   : DataFiles/SARSCOV2_<md>_<run>_free.mtz exists
+      xia_error : xia2.error exists
+      dmpl_err  : a <name>*dmpl*.err file exists
+      serials   : {N : set of extensions} for the <md>_<run>_00N.* files
+    """
+
+    __slots__ = ['xia_mtz', 'xia_error', 'dmpl_err', 'serials']
+
+    def __init__(self):
+        self.xia_mtz   = False
+        self.xia_error = False
+        self.dmpl_err  = False
+        self.serials   = {}
+        return
+
+
+    def has_serial(self, serial, ext='mtz'):
+        return ext in self.serials.get(serial, set())
+
+
+class ResultsIndex:
+    """
+    Walks <results_dir>/<name>/ once with os.scandir and records the
+    status of every <metadata>/<metadata>_<run> output directory, so
+    status queries need no further filesystem access.
+    """
+
+    def __init__(self, results_dir, name, store=None):
+
+        self.root  = os.path.join(results_dir, name)
+        self.name  = name
+        self.store = store
+
+        self._status = {} # (metadata, run) --> DatasetStatus
+        self._mtime  = {} # (metadata, run) --> output dir mtime
+
+        self.scan()
+
+        return
+
+
+    def scan(self):
+        """
+        With a StateStore, datasets whose directory mtime is unchanged
+        since the last scan and whose status is terminal (finished or
+        failed) are taken from the store without listing them again.
+        """
+
+        known   = self.store.load() if self.store else {}
+        status  = {}
+        mtimes  = {}
+        changed = []
+
+        for md_entry in _scandir(self.root):
+            if not md_entry.is_dir():
+                continue
+            metadata = md_entry.name
+            run_ptn  = re.compile(re.escape(metadata) + r'_(\d+)$')
+
+            for ds_entry in _scandir(md_entry.path):
+                g = run_ptn.match(ds_entry.name)
+                if not (g and ds_entry.is_dir()):
+                    continue
+                md = (metadata, int(g.groups()[0]))
+
+                mtime = ds_entry.stat().st_mtime
+                if md in known:
+                    old_mtime, st = known[md]
+                    if old_mtime == mtime and _is_terminal(st):
+                        status[md], mtimes[md] = st, mtime
+                        continue
+
+                st = self._scan_dataset(ds_entry.path, *md)
+                status[md], mtimes[md] = st, mtime
+                changed.append(md)
+
+        self._status = status
+        self._mtime  = mtimes
+
+        if self.store:
+            self.store.save([ (md, run, mtimes[(md, run)], status[(md, run)])
+                              for md, run in changed ])
+
+        return
+
+
+    def dir_mtime(self, metadata, run):
+        return self._mtime.get((metadata, run), None)
+
+
+    def _scan_dataset(self, path, metadata, run):
+
+        st = DatasetStatus()
+
+        xia_mtz    = 'SARSCOV2_{}_{:03d}_free.mtz'.format(metadata, run)
+        serial_ptn = re.compile(re.escape('{}_{:03d}_'.format(metadata, run))
+                                + r'(\d+)\.(\w+)$')
+
+        for entry in _scandir(path):
+
+            if entry.name == 'DataFiles':
+                if entry.is_dir():
+                    st.xia_mtz = any([ e.name == xia_mtz for e in _scandir(entry.path) ])
+
+            elif entry.name == 'xia2.error':
+                st.xia_error = True
+
+            elif fnmatch(entry.name, '{}*dmpl*.err'.format(self.name)):
+                st.dmpl_err = True
+
+            else:
+                g = serial_ptn.match(entry.name)
+                if g:
+                    serial, ext = g.groups()
+                    st.serials.setdefault(int(serial), set()).add(ext)
+
+        return st
+
+
+    def __contains__(self, md):
+        return tuple(md) in self._status
+
+
+    def __len__(self):
+        return len(self._status)
+
+
+    def status(self, metadata, run):
+        """
+        Return the DatasetStatus, an empty one if the directory is missing
+        """
+        return self._status.get((metadata, run), DatasetStatus())
+
+
+    def xia_result(self, metadata, run):
+        st = self.status(metadata, run)
+        if st.xia_mtz:
+            return 'finished'
+        elif st.xia_error:
+            return 'procfail'
+        return 'notdone'
+
+
+    def dmpl_result(self, metadata, run):
+        st = self.status(metadata, run)
+        if st.has_serial(3, 'mtz'):
+            return 'finished'
+        elif st.dmpl_err:
+            return 'procfail'
+        return 'notdone'
+
+
+def _is_terminal(st):
+    return st.xia_mtz or st.xia_error or st.has_serial(3, 'mtz') or st.dmpl_err
+
+
+def _scandir(path):
+    """
+    List a directory, an empty list if it does not exist
+    """
+    try:
+        with os.scandir(path) as it:
+            return list(it)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
@@ -0,0 +1,101 @@
+"""
+Priority ordering of the datasets to submit
+"""
+
+import time
+
+
+class PriorityScheduler:
+    """
+    Ranks (metadata, run) candidates by a score built from
+
+        recency    : 0.5 ** (age of the raw data directory / half_life [h])
+        resolution : 1 / resolution_cc [1/A], so better data score higher
+        targets    : a fixed bonus per target, {target : weight}
+
+    each term multiplied by its weight, and caps how many datasets of
+    each target are submitted per cycle with `quotas`, {target : n};
+    the 'default' entry applies to unlisted targets.
+
+    Subclass and override score() to plug in a different policy.
+    """
+
+    def __init__(self, recency=1.0, half_life=24.0, resolution=1.0,
+                 targets={}, quotas={}):
+
+        if half_life <= 0:
+            raise ValueError('priority half_life must be > 0 [h], got: {}'.format(half_life))
+
+        self.recency    = recency
+        self.half_life  = half_life
+        self.resolution = resolution
+        self.targets    = targets
+        self.quotas     = quotas
+
+        return
+
+
+    @property
+    def needs(self):
+        """
+        The fields score() and the quotas use, to avoid fetching the rest
+        """
+        needs = set()
+        if self.recency:
+            needs.add('mtime')
+        if self.resolution:
+            needs.add('resolution_cc')
+        if self.targets or self.quotas:
+            needs.add('target')
+        return needs
+
+
+    def score(self, fields, now=None):
+        """
+        Score one candidate from its fields, a dict that may be missing
+        any of mtime, resolution_cc and target
+        """
+
+        if now is None:
+            now = time.time()
+
+        score = 0.0
+
+        mtime = fields.get('mtime')
+        if self.recency and (mtime is not None):
+            age_h  = max(now - mtime, 0.0) / 3600.0
+            score += self.recency * 0.5 ** (age_h / self.half_life)
+
+        res = fields.get('resolution_cc')
+        if self.resolution and res:
+            score += self.resolution / res
+
+        score += self.targets.get(fields.get('target'), 0.0)
+
+        return score
+
+
+    def rank(self, mds, fields):
+        """
+        Return mds sorted from highest to lowest score
+        """
+        now = time.time()
+        return sorted(mds, key=lambda md: self.score(fields.get(md, {}), now=now),
+                      reverse=True)
+
+
+    def apply_quotas(self, mds, fields):
+        """
+        Lazily yield from mds, skipping datasets whose target has already
+        used up its quota
+        """
+
+        counts = {}
+        for md in mds:
+            target = fields.get(md, {}).get('target')
+            quota  = self.quotas.get(target, self.quotas.get('default', None))
+            if (quota is not None) and (counts.get(target, 0) >= quota):
+                continue
+            counts[target] = counts.get(target, 0) + 1
+            yield md
+
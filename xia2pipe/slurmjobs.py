@@ -0,0 +1,311 @@
+"""
+A cached snapshot of our jobs in the SLURM queue
+"""
+
+import os
+import re
+import json
+import time
+import getpass
+import subprocess
+from collections import namedtuple
+from os.path import join as pjoin
+
+
+Job = namedtuple('Job', ['job_id', 'name', 'state', 'elapsed', 'node'])
+
+# resources used by a completed job, times in s and memory in MB
+JobUsage = namedtuple('JobUsage', ['job_id', 'name', 'elapsed', 'cpus', 'cpu_time', 'max_rss'])
+
+# columns of a job-array manifest, one row per array task
+MANIFEST_FIELDS = ['metadata', 'run', 'outdir', 'rawdir', 'resolution', 'mtz']
+
+# array jobs are named <pipeline>array, e.g. DIALS_1p7A-dmpl_array
+ARRAY_NAME = 'array'
+
+
+def elapsed_to_seconds(elapsed):
+    """
+    Convert a SLURM time, [D-][HH:]MM:SS, to seconds
+    """
+
+    if not elapsed or elapsed in ['INVALID', 'UNLIMITED']:
+        return 0
+
+    days = 0
+    if '-' in elapsed:
+        d, elapsed = elapsed.split('-', 1)
+        days = int(d)
+
+    parts = [ int(float(x)) for x in elapsed.split(':') ]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    h, m, s = parts
+
+    return ((days * 24 + h) * 60 + m) * 60 + s
+
+
+def memory_to_mb(memory):
+    """
+    Convert a SLURM memory size, e.g. 1234K, 1.5G or 6Gn, to MB
+    """
+
+    g = re.match(r'([\d.]+)([KMGT]?)', memory or '')
+    if not g:
+        return 0.0
+
+    value, unit = g.groups()
+    scale = {'' : 1.0/1024**2, 'K' : 1.0/1024, 'M' : 1.0, 'G' : 1024.0, 'T' : 1024.0**2}
+
+    return float(value) * scale[unit]
+
+
+def completed_jobs(days=14):
+    """
+    Return a JobUsage for each of our jobs that COMPLETED in the last
+    `days` days, from one sacct call
+    """
+
+    r = subprocess.run(['sacct', '--parsable2', '--noheader',
+                        '--state=COMPLETED',
+                        '--starttime=now-{}days'.format(int(days)),
+                        '--format=JobID,JobName,Elapsed,AllocCPUS,TotalCPU,MaxRSS'],
+                       capture_output=True, check=True)
+
+    jobs = {}
+    max_rss = {}
+    for line in r.stdout.decode("utf-8").split('\n'):
+        fields = line.strip().split('|')
+        if len(fields) < 6:
+            continue
+        job_id, name, elapsed, cpus, cpu_time, rss = fields[:6]
+
+        # MaxRSS is only reported for the steps, e.g. 1234.batch
+        if '.' in job_id:
+            parent = job_id.split('.')[0]
+            max_rss[parent] = max(max_rss.get(parent, 0.0), memory_to_mb(rss))
+            continue
+
+        jobs[job_id] = (name, elapsed_to_seconds(elapsed), int(cpus or 0),
+                        elapsed_to_seconds(cpu_time))
+
+    return [ JobUsage(job_id, name, elapsed, cpus, cpu_time, max_rss.get(job_id, 0.0))
+             for job_id, (name, elapsed, cpus, cpu_time) in jobs.items() ]
+
+
+def write_manifest(path, rows):
+    """
+    Write rows, dicts keyed by MANIFEST_FIELDS, as tab-separated lines;
+    line i (from 0) is read by array task i
+    """
+    with open(path, 'w') as f:
+        for row in rows:
+            values = [ str(row.get(k, '')) for k in MANIFEST_FIELDS ]
+            if any([ ('\t' in v) or ('\n' in v) for v in values ]):
+                raise ValueError('cannot write to manifest: {}'.format(values))
+            f.write('\t'.join(values) + '\n')
+    return
+
+
+def read_manifest(path):
+    """
+    Return the manifest rows as a list of dicts
+    """
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            rows.append( dict(zip(MANIFEST_FIELDS, values)) )
+    return rows
+
+
+def array_tasks(job_id):
+    """
+    Split an array JobID into (array_id, [task ids]):
+
+        1234_7            -> ('1234', [7])
+        1234_[0-3,8%10]   -> ('1234', [0, 1, 2, 3, 8])
+
+    Returns (job_id, None) for a job that is not part of an array.
+    """
+
+    g = re.match(r'(\d+)_(\d+)$', job_id)
+    if g:
+        return g.groups()[0], [int(g.groups()[1])]
+
+    g = re.match(r'(\d+)_\[([\d,\-]+)(%\d+)?\]$', job_id)
+    if g:
+        tasks = []
+        for rng in g.groups()[1].split(','):
+            if '-' in rng:
+                first, last = rng.split('-')
+                tasks.extend(range(int(first), int(last)+1))
+            elif rng:
+                tasks.append(int(rng))
+        return g.groups()[0], tasks
+
+    return job_id, None
+
+
+class JobSnapshot:
+    """
+    Our RUNNING/PENDING jobs, from one call to sacct (or squeue),
+    parsed into Job records.
+
+    The snapshot is cached, in memory and in `cache_path` (so that the
+    daemons and scripts share it), for `ttl` seconds.
+    """
+
+    states = ['RUNNING', 'PENDING']
+
+    def __init__(self, ttl=60, cache_path=None, source='sacct'):
+
+        if source not in ['sacct', 'squeue']:
+            raise ValueError('job source must be sacct or squeue, got: {}'.format(source))
+
+        self.ttl        = ttl
+        self.cache_path = cache_path
+        self.source     = source
+
+        self._jobs      = None
+        self._timestamp = 0.0
+
+        return
+
+
+    def _command(self):
+        if self.source == 'sacct':
+            return ['sacct', '--parsable2', '--noheader',
+                    '--state={}'.format(','.join(self.states)),
+                    '--format=JobID,JobName,State,Elapsed,NodeList']
+        else:
+            return ['squeue', '--noheader',
+                    '--user={}'.format(getpass.getuser()),
+                    '--states={}'.format(','.join(self.states)),
+                    '--format=%i|%j|%T|%M|%N']
+
+
+    def _query(self):
+
+        r = subprocess.run(self._command(), capture_output=True, check=True)
+
+        jobs = []
+        for line in r.stdout.decode("utf-8").split('\n'):
+            fields = line.strip().split('|')
+            if len(fields) < 5:
+                continue
+            job_id, name, state, elapsed, node = fields[:5]
+
+            # sacct also lists the job steps, e.g. 1234.batch
+            if '.' in job_id:
+                continue
+
+            jobs.append( Job(job_id, name, state.split()[0],
+                             elapsed_to_seconds(elapsed), node) )
+
+        return jobs
+
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - cached['timestamp'] > self.ttl:
+            return None
+        return cached['timestamp'], [ Job(*j) for j in cached['jobs'] ]
+
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        tmp = '{}.{}'.format(self.cache_path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'timestamp' : self._timestamp,
+                           'jobs'      : [ list(j) for j in self._jobs ]}, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            print(' ! could not write job cache: {}'.format(e))
+        return
+
+
+    def refresh(self):
+        self._jobs      = self._query()
+        self._timestamp = time.time()
+        self._save_cache()
+        return
+
+
+    def invalidate(self):
+        """
+        Forget the snapshot, e.g. after submitting new jobs
+        """
+        self._jobs = None
+        if self.cache_path:
+            try:
+                os.remove(self.cache_path)
+            except FileNotFoundError:
+                pass
+        return
+
+
+    @property
+    def jobs(self):
+
+        if (self._jobs is None) or (time.time() - self._timestamp > self.ttl):
+            cached = self._load_cache()
+            if cached:
+                self._timestamp, self._jobs = cached
+            else:
+                self.refresh()
+
+        return self._jobs
+
+
+    def index(self, pipeline, manifest_dir=None):
+        """
+        Return {(metadata, run) : Job}, see match_jobs
+        """
+        return dict(match_jobs(self.jobs, pipeline, manifest_dir=manifest_dir))
+
+
+def match_jobs(jobs, pipeline, manifest_dir=None):
+    """
+    Yield ((metadata, run), job) for the jobs named <pipeline><metadata>-<run>,
+    e.g. pipeline='DIALS_1p7A-dmpl_'
+
+    If manifest_dir is given, the tasks of <pipeline>array jobs are
+    included too, looked up in <manifest_dir>/<array job id>.tsv
+    """
+
+    ptn = re.compile(re.escape(pipeline) + r'(\w+)-(\d+)$')
+
+    manifests = {}
+    for job in jobs:
+
+        g = ptn.match(job.name)
+        if g:
+            metadata, run = g.groups()
+            yield (metadata, int(run)), job
+
+        elif manifest_dir and (job.name == pipeline + ARRAY_NAME):
+            array_id, tasks = array_tasks(job.job_id)
+            if tasks is None:
+                continue
+            if array_id not in manifests:
+                try:
+                    manifests[array_id] = read_manifest(pjoin(manifest_dir,
+                                                      '{}.tsv'.format(array_id)))
+                except OSError:
+                    print(' ! no manifest for array job: {}'.format(array_id))
+                    manifests[array_id] = []
+            rows = manifests[array_id]
+            for task in tasks:
+                if task < len(rows):
+                    yield (rows[task]['metadata'], int(rows[task]['run'])), job
+
+    return
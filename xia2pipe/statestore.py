@@ -0,0 +1,325 @@
+"""
+A persistent, local record of the pipeline state of each dataset
+"""
+
+import json
+import time
+import sqlite3
+import threading
+import functools
+
+from xia2pipe.resultscan import DatasetStatus
+from xia2pipe.rawindex import RawDataset
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    metadata    TEXT    NOT NULL,
+    run         INTEGER NOT NULL,
+    pipeline    TEXT    NOT NULL,
+    dir_mtime   REAL,
+    status      TEXT,
+    PRIMARY KEY (metadata, run, pipeline)
+);
+CREATE TABLE IF NOT EXISTS raw_datasets (
+    path        TEXT    PRIMARY KEY,
+    metadata    TEXT    NOT NULL,
+    run         INTEGER NOT NULL,
+    counts      TEXT,
+    dir_mtime   REAL
+);
+CREATE TABLE IF NOT EXISTS raw_complete (
+    path        TEXT    NOT NULL,
+    min_frames  INTEGER NOT NULL,
+    PRIMARY KEY (path, min_frames)
+);
+CREATE TABLE IF NOT EXISTS raw_missing (
+    metadata    TEXT    NOT NULL,
+    run         INTEGER NOT NULL,
+    first_seen  REAL,
+    n_checks    INTEGER,
+    next_check  REAL,
+    PRIMARY KEY (metadata, run)
+);
+CREATE TABLE IF NOT EXISTS raw_md_dirs (
+    path        TEXT    PRIMARY KEY,
+    dir_mtime   REAL,
+    datasets    TEXT
+);
+CREATE TABLE IF NOT EXISTS raw_frames (
+    path        TEXT    PRIMARY KEY,
+    dir_mtime   REAL,
+    frames      INTEGER
+);
+CREATE TABLE IF NOT EXISTS job_history (
+    job_id      TEXT    NOT NULL,
+    pipeline    TEXT    NOT NULL,
+    metadata    TEXT    NOT NULL,
+    run         INTEGER NOT NULL,
+    elapsed     REAL,
+    cpus        INTEGER,
+    cpu_time    REAL,
+    max_rss     REAL,
+    frames      INTEGER,
+    resolution  REAL,
+    space_group INTEGER,
+    PRIMARY KEY (job_id, pipeline)
+);
+"""
+
+
+def _status_to_json(st):
+    return json.dumps({
+                       'xia_mtz'   : st.xia_mtz,
+                       'xia_error' : st.xia_error,
+                       'dmpl_err'  : st.dmpl_err,
+                       'serials'   : { str(k) : sorted(v) for k,v in st.serials.items() },
+                      })
+
+
+def _status_from_json(txt):
+    d = json.loads(txt)
+    st = DatasetStatus()
+    st.xia_mtz   = d['xia_mtz']
+    st.xia_error = d['xia_error']
+    st.dmpl_err  = d['dmpl_err']
+    st.serials   = { int(k) : set(v) for k,v in d['serials'].items() }
+    return st
+
+
+def _locked(method):
+    """
+    Serialise access to the sqlite connection between threads
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class StateStore:
+    """
+    SQLite database (kept under results_dir) that remembers, for each
+    (metadata, run, pipeline), the on-disk DatasetStatus and the output
+    directory mtime, so that only datasets whose directory changed, or
+    whose status is not terminal, need to be looked at again. It also keeps
+    the RawDataIndex of the raw data between runs, and the resources
+    used by completed SLURM jobs.
+    """
+
+    def __init__(self, path, pipeline):
+
+        self.path     = path
+        self.pipeline = pipeline
+
+        # cron jobs for different daemons may share the file, and
+        # threads within one daemon share the connection
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+
+        return
+
+
+    @_locked
+    def close(self):
+        self._conn.close()
+        return
+
+
+    @_locked
+    def load(self):
+        """
+        Return {(metadata, run) : (dir_mtime, DatasetStatus)}
+        """
+        cur = self._conn.execute('SELECT metadata, run, dir_mtime, status '
+                                 'FROM datasets WHERE pipeline = ?',
+                                 (self.pipeline,))
+        return { (md, run) : (mtime, _status_from_json(st))
+                 for md, run, mtime, st in cur.fetchall() if st is not None }
+
+
+    @_locked
+    def save(self, entries):
+        """
+        entries : [(metadata, run, dir_mtime, DatasetStatus)]
+        """
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO datasets '
+                '(metadata, run, pipeline, dir_mtime, status) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [ (md, run, self.pipeline, mtime, _status_to_json(st))
+                  for md, run, mtime, st in entries ]
+            )
+        return
+
+
+    @_locked
+    def load_raw(self):
+        """
+        Return ({path : RawDataset}, {md_dir : (mtime, [dataset paths])})
+        """
+
+        cur = self._conn.execute('SELECT path, metadata, run, counts, dir_mtime '
+                                 'FROM raw_datasets')
+        datasets = { path : RawDataset(path, md, run, json.loads(counts), mtime)
+                     for path, md, run, counts, mtime in cur.fetchall() }
+
+        cur = self._conn.execute('SELECT path, dir_mtime, datasets FROM raw_md_dirs')
+        md_dirs = { path : (mtime, json.loads(ds))
+                    for path, mtime, ds in cur.fetchall() }
+
+        return datasets, md_dirs
+
+
+    @_locked
+    def save_raw(self, changed, removed, md_dirs):
+        """
+        changed : [RawDataset] to insert/update
+        removed : [path] of datasets no longer on disk
+        md_dirs : the complete {md_dir : (mtime, [dataset paths])}
+        """
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO raw_datasets '
+                '(path, metadata, run, counts, dir_mtime) VALUES (?, ?, ?, ?, ?)',
+                [ (ds.path, ds.metadata, ds.run, json.dumps(ds.counts), ds.dir_mtime)
+                  for ds in changed ]
+            )
+            self._conn.executemany('DELETE FROM raw_datasets WHERE path = ?',
+                                   [ (p,) for p in removed ])
+            self._conn.execute('DELETE FROM raw_md_dirs')
+            self._conn.executemany(
+                'INSERT INTO raw_md_dirs (path, dir_mtime, datasets) VALUES (?, ?, ?)',
+                [ (p, mtime, json.dumps(ds)) for p, (mtime, ds) in md_dirs.items() ]
+            )
+        return
+
+
+    @_locked
+    def load_complete(self, min_frames):
+        """
+        Return the set of raw dataset paths known to hold > min_frames frames
+        """
+        cur = self._conn.execute('SELECT path FROM raw_complete WHERE min_frames >= ?',
+                                 (min_frames,))
+        return set([ row[0] for row in cur.fetchall() ])
+
+
+    @_locked
+    def add_complete(self, paths, min_frames):
+        with self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO raw_complete '
+                                   '(path, min_frames) VALUES (?, ?)',
+                                   [ (p, min_frames) for p in paths ])
+        return
+
+
+    @_locked
+    def load_frame_totals(self):
+        """
+        Return the full frame counts, {path : (dir_mtime, frames)}
+        """
+        cur = self._conn.execute('SELECT path, dir_mtime, frames FROM raw_frames')
+        return { path : (mtime, frames) for path, mtime, frames in cur.fetchall() }
+
+
+    @_locked
+    def add_frame_totals(self, totals):
+        """
+        totals : [(path, dir_mtime, frames)]
+        """
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO raw_frames '
+                                   '(path, dir_mtime, frames) VALUES (?, ?, ?)', totals)
+        return
+
+
+    @_locked
+    def load_missing(self):
+        """
+        Return the negative cache, {(metadata, run) : time before which
+        it should be assumed to have no raw data}
+        """
+        cur = self._conn.execute('SELECT metadata, run, next_check FROM raw_missing')
+        return { (md, run) : next_check for md, run, next_check in cur.fetchall() }
+
+
+    @_locked
+    def update_missing(self, missing, found, interval, max_interval):
+        """
+        Record another failed search for raw data for each (metadata, run)
+        in `missing`, the next check is due after interval * 2**(n_checks-1),
+        capped at max_interval; drop those in `found`. One transaction.
+        """
+
+        now = time.time()
+
+        cur = self._conn.execute('SELECT metadata, run, first_seen, n_checks '
+                                 'FROM raw_missing')
+        known = { (md, run) : (first_seen, n_checks)
+                  for md, run, first_seen, n_checks in cur.fetchall() }
+
+        rows = []
+        for md, run in missing:
+            first_seen, n_checks = known.get((md, run), (now, 0))
+            wait = min(interval * 2**n_checks, max_interval)
+            rows.append( (md, run, first_seen, n_checks + 1, now + wait) )
+
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO raw_missing '
+                                   '(metadata, run, first_seen, n_checks, next_check) '
+                                   'VALUES (?, ?, ?, ?, ?)', rows)
+            self._conn.executemany('DELETE FROM raw_missing '
+                                   'WHERE metadata = ? AND run = ?',
+                                   [ (md, run) for md, run in found ])
+        return
+
+
+    @_locked
+    def clear_missing(self, metadata=None, run=None):
+        """
+        Drop (metadata, run) from the negative cache; with no arguments,
+        clear it entirely. Returns the number of entries removed.
+        """
+        with self._conn:
+            if metadata is None:
+                cur = self._conn.execute('DELETE FROM raw_missing')
+            elif run is None:
+                cur = self._conn.execute('DELETE FROM raw_missing WHERE metadata = ?',
+                                         (metadata,))
+            else:
+                cur = self._conn.execute('DELETE FROM raw_missing '
+                                         'WHERE metadata = ? AND run = ?',
+                                         (metadata, run))
+        return cur.rowcount
+
+
+    _HISTORY_FIELDS = ['job_id', 'metadata', 'run', 'elapsed', 'cpus', 'cpu_time',
+                       'max_rss', 'frames', 'resolution', 'space_group']
+
+    @_locked
+    def load_job_history(self, pipeline):
+        """
+        Return the completed jobs of `pipeline` (a job name prefix) as
+        dicts keyed by job_id, metadata, run, elapsed, ...
+        """
+        cur = self._conn.execute('SELECT {} FROM job_history WHERE pipeline = ?'
+                                 ''.format(', '.join(self._HISTORY_FIELDS)),
+                                 (pipeline,))
+        return [ dict(zip(self._HISTORY_FIELDS, row)) for row in cur.fetchall() ]
+
+
+    @_locked
+    def add_job_history(self, pipeline, records):
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO job_history (pipeline, {}) VALUES (?, {})'
+                ''.format(', '.join(self._HISTORY_FIELDS),
+                          ', '.join(['?'] * len(self._HISTORY_FIELDS))),
+                [ [pipeline] + [ r.get(k) for k in self._HISTORY_FIELDS ]
+                  for r in records ]
+            )
+        return
@@ -0,0 +1,163 @@
+"""
+Concurrent, rate-limited sbatch submission
+"""
+
+import os
+import asyncio
+
+
+class SubmitResult:
+    """
+    What happened to each script handed to the Submitter:
+
+        submitted : {key : job_id}
+        failed    : {key : error message}
+        held      : [key, ...] not submitted, the pending cap was reached
+    """
+
+    def __init__(self):
+        self.submitted = {}
+        self.failed    = {}
+        self.held      = []
+        return
+
+
+    def report(self):
+        print('Submitted:                       {}'.format(len(self.submitted)))
+        if len(self.held) > 0:
+            print('Held back (queue full):          {}'.format(len(self.held)))
+        if len(self.failed) > 0:
+            print('Failed to submit:                {}'.format(len(self.failed)))
+            for key, err in self.failed.items():
+                print(' ! {}: {}'.format(key, err))
+        return
+
+
+class Submitter:
+    """
+    Runs sbatch for many scripts, at most `concurrency` at a time.
+
+    `pending` is the number of our jobs already PENDING in the queue;
+    every successful submission adds one, and once `max_pending` is
+    reached the remaining scripts are held back for the next cycle.
+    A failed sbatch is recorded in the result rather than raised.
+
+    The scripts are removed once handled, whether submitted (sbatch
+    keeps its own copy), failed or held back.
+    """
+
+    def __init__(self, concurrency=4, max_pending=None, pending=0,
+                 timeout=60, sbatch='/usr/bin/sbatch'):
+
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.pending     = pending
+        self.timeout     = timeout
+        self.sbatch      = sbatch
+
+        self._in_flight  = 0
+
+        return
+
+
+    def _queue_full(self):
+        return (self.max_pending is not None) and \
+               (self.pending + self._in_flight >= self.max_pending)
+
+
+    async def _reserve(self, changed):
+        """
+        Reserve a queue slot, return False if there is none. While
+        submissions that may still fail are in flight, wait for them
+        rather than hold back a script that could fit.
+        """
+        async with changed:
+            while self._queue_full() and self._in_flight > 0:
+                await changed.wait()
+            if self._queue_full():
+                return False
+            self._in_flight += 1
+        return True
+
+
+    async def _release(self, changed, submitted):
+        async with changed:
+            self._in_flight -= 1
+            if submitted:
+                self.pending += 1
+            changed.notify_all()
+        return
+
+
+    async def _sbatch(self, script, args):
+        """
+        Return the job id, raise RuntimeError if sbatch fails
+        """
+
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                            self.sbatch, '--parsable', *args, script,
+                            stdout=asyncio.subprocess.PIPE,
+                            stderr=asyncio.subprocess.PIPE)
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(),
+                                                  self.timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise
+        except (OSError, asyncio.TimeoutError) as e:
+            raise RuntimeError('{}: {}'.format(type(e).__name__, e))
+
+        if proc.returncode != 0:
+            raise RuntimeError(err.decode('utf-8').strip() or
+                               'sbatch exited with {}'.format(proc.returncode))
+
+        return out.decode('utf-8').strip().split(';')[0]
+
+
+    async def _submit_one(self, key, script, args, slots, changed, result):
+
+        async with slots:
+
+            if not await self._reserve(changed):
+                result.held.append(key)
+                _remove(script)
+                return
+
+            try:
+                result.submitted[key] = await self._sbatch(script, args)
+            except RuntimeError as e:
+                result.failed[key] = str(e)
+
+            await self._release(changed, key in result.submitted)
+            _remove(script)
+
+        return
+
+
+    async def _submit_all(self, scripts, extra_args):
+        result  = SubmitResult()
+        slots   = asyncio.Semaphore(self.concurrency)
+        changed = asyncio.Condition()
+        await asyncio.gather(*[ self._submit_one(key, script, extra_args.get(key, []),
+                                                 slots, changed, result)
+                                for key, script in scripts ])
+        return result
+
+
+    def submit(self, scripts, extra_args=None):
+        """
+        Submit [(key, script_path), ...], return a SubmitResult;
+        extra_args, {key : [sbatch option, ...]}, are added to the
+        sbatch command line of those scripts
+        """
+        return asyncio.run(self._submit_all(list(scripts), extra_args or {}))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return
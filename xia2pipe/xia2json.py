@@ -0,0 +1,202 @@
+"""
+Selective reader for the xia2.json written by xia2 in scale/
+"""
+
+import os
+import re
+import json
+import mmap
+from os.path import join as pjoin
+
+
+_decoder = json.JSONDecoder()
+
+
+class LayoutError(Exception):
+    """
+    The file does not look the way the selective reader expects
+    """
+    pass
+
+
+def _key_positions(buf, key):
+    """
+    Return the offsets just after every `"key":` in buf
+    """
+    ptn = re.compile(b'"' + re.escape(key.encode()) + rb'"\s*:\s*')
+    return [ m.end() for m in ptn.finditer(buf) ]
+
+
+def _decode_at(buf, pos, window=65536):
+    """
+    Decode the single JSON value that starts at buf[pos], decoding
+    only as much of the file as needed
+    """
+    while True:
+        end  = min(pos + window, len(buf))
+        text = buf[pos:end].decode('utf-8', errors='replace')
+        try:
+            value, n = _decoder.raw_decode(text)
+            # a number running up to the window edge may be cut short
+            if n < len(text) or end == len(buf):
+                return value
+        except json.JSONDecodeError:
+            if end == len(buf):
+                raise LayoutError('cannot decode value at offset {}'.format(pos))
+        window *= 4
+
+
+def _single_value(buf, key):
+    positions = _key_positions(buf, key)
+    if len(positions) != 1:
+        raise LayoutError('expected one `{}`, found {}'.format(key, len(positions)))
+    return _decode_at(buf, positions[0])
+
+
+# a string (with escapes) or a bracket, so that brackets inside strings
+# are not counted when tracking the nesting depth
+_token = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+
+def _first_integrater_value(buf, pos, key):
+    """
+    Decode `key` of the first integrater in the `_scalr_integraters`
+    object starting at buf[pos]. Only the integrater's own key counts,
+    not one of the same name in an object nested inside it.
+    """
+
+    name  = b'"' + key.encode() + b'"'
+    colon = re.compile(rb'\s*:\s*')
+    depth = 0
+
+    if buf[pos:pos+1] != b'{':
+        raise LayoutError('`_scalr_integraters` is not an object')
+
+    # _scalr_integraters is at depth 1, its integraters' own keys at 2
+    for m in _token.finditer(buf, pos):
+        tok = m.group()
+        if tok in (b'{', b'['):
+            depth += 1
+        elif tok in (b'}', b']'):
+            depth -= 1
+            if depth < 2:
+                break
+        elif depth == 2 and tok == name:
+            c = colon.match(buf, m.end())
+            if c is not None:
+                return _decode_at(buf, c.end(), window=64)
+
+    raise LayoutError('no `{}` in the first integrater'.format(key))
+
+
+def read_selective(json_path):
+    """
+    Pull just the scaling summary out of an xia2.json:
+
+        cell        : [a, b, c, alpha, beta, gamma] (_scalr_cell)
+        space_group : _intgr_spacegroup_number of the first integrater
+        stats       : first entry of _scalr_statistics (overall res. range)
+
+    The file is memory-mapped and only the values of these keys are
+    decoded; nothing else is turned into Python objects. Raises
+    LayoutError if the file does not have the expected layout.
+    """
+
+    with open(json_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+
+            cell  = _single_value(buf, '_scalr_cell')
+            stats = _single_value(buf, '_scalr_statistics')
+
+            intgr = _key_positions(buf, '_scalr_integraters')
+            if len(intgr) != 1:
+                raise LayoutError('expected one `_scalr_integraters`')
+            space_group = _first_integrater_value(buf, intgr[0],
+                                                  '_intgr_spacegroup_number')
+
+    if not (type(cell) is list and len(cell) == 6):
+        raise LayoutError('unexpected `_scalr_cell`: {}'.format(cell))
+    if not (type(stats) is dict and len(stats) > 0):
+        raise LayoutError('unexpected `_scalr_statistics`')
+    if type(space_group) is not int:
+        raise LayoutError('unexpected `_intgr_spacegroup_number`')
+
+    return cell, space_group, list(stats.values())[0]
+
+
+def read_full(json_path):
+    """
+    The same as read_selective, via json.load of the whole file
+    """
+
+    root = json.load(open(json_path, 'r'))
+
+    # here, cell = [a, b, c, alpha, beta, gamma]
+    cell = root['_scalr_cell']
+
+    # this one has some strange float-like key, but there is only one
+    k = list(root['_scalr_integraters'])[0]
+    space_group = root['_scalr_integraters'][k]['_intgr_spacegroup_number']
+
+    # these are keyed by something nasty like '["SARSCOV2", "l6p17_10", "NATIVE"]'
+    # but we expect just one sub-directory, so grab that...
+    # we want the first entry, which is the entire resolution range
+    # the other two are low & high res reflections only
+    ss = list(root['_scalr_statistics'].values())[0]
+
+    return cell, space_group, ss
+
+
+def read_xia2_json(json_path):
+    """
+    Return (cell, space_group, stats), falling back on the full parser
+    when the selective one does not recognise the layout
+    """
+    try:
+        return read_selective(json_path)
+    except (LayoutError, ValueError):
+        return read_full(json_path)
+
+
+def xia2_json_paths(outdir, metadata, run):
+    """
+    Where the xia2.json of (metadata, run) may be under its xia2 outdir,
+    most likely first: <metadata>_<run>/scale/, or <metadata>/scale/ for
+    a few old datasets processed with just the metadata field
+    """
+    return [ pjoin(outdir, '{}_{:03d}'.format(metadata, run), 'scale/xia2.json'),
+             pjoin(outdir, '{}'.format(metadata), 'scale/xia2.json') ]
+
+
+def find_xia2_json(outdir, metadata, run):
+    """
+    Return the path of the xia2.json of (metadata, run), raise IOError
+    if there is none
+    """
+    for json_path in xia2_json_paths(outdir, metadata, run):
+        if os.path.exists(json_path):
+            return json_path
+    raise IOError('cannot find DIALS json for '
+                  '{}_{:03d}'.format(metadata, run))
+
+
+def refinement_resolution(json_path, rescut=-1.0):
+    """
+    The resolution to refine to: the larger of the xia2 CC1/2 cut and
+    the requested rescut, as in ProjectBase.get_refinement_res
+    """
+    _, _, stats = read_xia2_json(json_path)
+    res = max(float(stats['High resolution limit'][0]), float(rescut))
+    if res < 0.0:
+        raise ValueError('resolution < 0.0 in: {}'.format(json_path))
+    return res
+
+
+if __name__ == '__main__':
+
+    # used by chained refinement jobs:
+    #   xia2json.py <xia2 outdir> <metadata> <run> [rescut]
+    import sys
+    rescut = sys.argv[4] if len(sys.argv) > 4 else -1.0
+    json_path = find_xia2_json(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+    print(refinement_resolution(json_path, rescut))
@@ -1,19 +1,45 @@
 
 import os
-import sys
-import re
 import time
 import subprocess
 import argparse
 
 from glob import glob
+from itertools import islice
 
 from xia2pipe.projbase import ProjectBase
+from xia2pipe.dmpldaemon import DimplingDaemon
+from xia2pipe.slurmjobs import ARRAY_NAME, read_manifest
+from xia2pipe.resources import largest
 
 
 class XiaDaemon(ProjectBase):
 
-    def submit_unfinished(self, verbose=False, limit=None):
+    # only the datasets of self.target are reduced
+    multi_target = False
+
+    # resolution and space group are only known after reduction
+    submit_features = ('frames',)
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        # the DimplingDaemon chained onto our xia2 jobs, see `refinement`
+        self._refinement = None
+        if self.slurm_config.get('chain_refinement'):
+            dd = DimplingDaemon.load_config(self.slurm_config['chain_refinement'])
+            if dd.reduction_pipeline_name != self.reduction_pipeline_name:
+                raise ValueError('chain_refinement config {} refines reduction_pipeline={}, '
+                                 'but this xia2 pipeline is {}'
+                                 ''.format(self.slurm_config['chain_refinement'],
+                                           dd.reduction_pipeline_name,
+                                           self.reduction_pipeline_name))
+            self._refinement = dd
+
+        return
+
+    def submit_unfinished(self, verbose=False, limit=None, full_scan=False):
         """
         Check:
 
@@ -23,6 +49,10 @@ class XiaDaemon(ProjectBase):
           -- which not already submitted
 
         And submits any missing.
+
+        With a `limit`, the checks stop as soon as that many datasets to
+        submit are found (see iter_unfinished); full_scan=True checks
+        every dataset and reports the counts at each stage.
         """
 
         t = time.localtime()
@@ -31,16 +61,85 @@ class XiaDaemon(ProjectBase):
         print('>> xia2 daemon crunching latest results...')
         print('>>', current_time)
 
+        if full_scan or (limit is None):
+            to_run, fields = self.rank_candidates(self._scan_unfinished(verbose=verbose))
+            to_run = list(islice(self.apply_quotas(to_run, fields), limit))
+        else:
+            to_run = list(islice(self.iter_unfinished(), limit))
+
+        # the raw data checks above only recorded what they found
+        self.save_missing()
+
+        # submit the rest
+        if verbose:
+            print('Submitting:                      {}'.format(len(to_run)))
+            
+        to_submit = list(to_run)[:limit]
+        if self.slurm_config.get('array', False):
+            job_ids = self.submit_batch(to_submit).submitted
+        else:
+            scripts, failed = self.prepare_jobs(to_submit, self.write_script)
+            job_ids = self.submit_scripts('{}_'.format(self.name), scripts,
+                                          failed=failed).submitted
+
+        # refinement waits for xia2 in the queue, not for the next cycle
+        if self.refinement is not None and len(job_ids) > 0:
+            self.chain_refinement(job_ids)
+
+        # the cached job snapshot no longer includes what we submitted
+        if len(to_run) > 0:
+            self.jobs.invalidate()
+
+        return
+
+
+    def iter_unfinished(self):
+        """
+        Lazily yield the (metadata, run) to submit, in priority order,
+        cheapest check first: not running on SLURM, no xia2 result, raw
+        data present
+        """
+
+        running = set(self.fetch_running_jobs())
+
+        # highest priority first, see rank_candidates
+        # (build the shared indices first, not inside the thread pool)
+        self.load_diffractions()
+        self.load_raw_index()
+        self.load_missing()
+        ranked, fields = self.rank_candidates(self.fetch_diffraction_successes())
+
+        candidates = ( md for md in ranked if md not in running )
+
+        candidates = self.probe_filter(self.xia_result, candidates,
+                                       keep=lambda r: r not in ['finished', 'procfail'])
+
+        candidates = self.probe_filter(self.raw_data_exists, candidates)
+
+        return self.apply_quotas(candidates, fields)
+
+
+    def _scan_unfinished(self, verbose=False):
+        """
+        Check every dataset at every stage, return the set to submit
+        """
+
+        # one pass over the results tree serves all status checks below
+        self.scan_results()
+
         # fetch all xtals labeled success in db
         to_run = set(self.fetch_diffraction_successes())
         if verbose:
             print('Fetched from database:           {}'.format(len(to_run)))
 
         # remove those for which we cannot locate the raw data
-        to_rm = []
-        for md in list(to_run):
-            if not self.raw_data_exists(*md):
-                to_rm.append(md)
+        # (build the shared indices first, not inside the thread pool)
+        self.load_diffractions()
+        self.load_raw_index()
+        self.load_missing()
+        candidates = list(to_run)
+        exists = self.probe(self.raw_data_exists, candidates)
+        to_rm  = [ md for md, e in zip(candidates, exists) if not e ]
         to_run = to_run - set(to_rm)
 
         if verbose:
@@ -51,11 +150,12 @@ class XiaDaemon(ProjectBase):
         to_rm = []
         successes = 0
         failures  = 0
-        for md in to_run:
-            if self.xia_result(*md) == 'finished':
+        candidates = list(to_run)
+        for md, result in zip(candidates, self.probe(self.xia_result, candidates)):
+            if result == 'finished':
                 to_rm.append(md)
                 successes += 1
-            elif self.xia_result(*md) == 'procfail':
+            elif result == 'procfail':
                 to_rm.append(md)
                 failures  += 1
         to_run = to_run - set(to_rm)
@@ -69,14 +169,40 @@ class XiaDaemon(ProjectBase):
         if verbose:
             print('Running on SLURM:                {}'.format(len(running)))
 
-        # submit the rest
-        if verbose:
-            print('Submitting:                      {}'.format(len(to_run)))
-            
-        for md in list(to_run)[:limit]:
-            self.submit_run(*md)
+        return to_run
 
-        return
+
+    @property
+    def refinement(self):
+        """
+        The DimplingDaemon chained onto our xia2 jobs, loaded from the
+        config file in slurm: chain_refinement; None if not chained
+        """
+        return self._refinement
+
+
+    def chain_refinement(self, job_ids):
+        """
+        Submit refinement of each {(metadata, run) : xia2 job id}, to start
+        once that xia2 job has succeeded; returns a SubmitResult
+        """
+
+        dd = self.refinement
+
+        def write_script(metadata, run):
+            xia_outdir = self.metadata_to_outdir(metadata, run)
+            return dd.write_chained_script(metadata, run, xia_outdir,
+                                           job_ids[(metadata, run)])
+
+        scripts, failed = dd.prepare_jobs(job_ids.keys(), write_script)
+
+        print('Chaining refinement:             {}'.format(len(job_ids)))
+        result = dd.submit_scripts('{}-dmpl_'.format(dd.name), scripts, failed=failed)
+
+        if len(result.submitted) > 0:
+            dd.jobs.invalidate()
+
+        return result
 
 
     def fetch_diffraction_successes(self):
@@ -91,27 +217,17 @@ class XiaDaemon(ProjectBase):
 
     def fetch_running_jobs(self):
         """
-        Return a list of metadata str that are running on SLURM
+        Return a list of (metadata, run) that are running on SLURM
         """
+        return list(self.jobs.index('{}_'.format(self.name),
+                                    manifest_dir=self.array_dir).keys())
 
-        running = []
 
-        r = subprocess.run('sacct --format="JobID,JobName%50" --state="RUNNING,PENDING"',
-                           capture_output=True, shell=True, check=True)
-        
-        lines = r.stdout.decode("utf-8").split('\n')
-        for line in lines:
-            g = re.search('{}_(\w+)-(\d)'.format(self.name), line)
-            if g:
-                grps = g.groups()
-                running.append( (grps[0], int(grps[1])) ) # metadata, run_id
-
-        return running
-
-
-    def submit_run(self, metadata, run, debug=False, allow_overwrite=True):
+    def _make_outdir(self, metadata, run, allow_overwrite=True):
+        """
+        Create the directory sub-structure, return (rawdir, outdir)
+        """
 
-        # first, create the directory sub-structure
         rawdir, _ = self.metadata_to_dataset_path(metadata, run)
         outdir    = self.metadata_to_outdir(metadata, run)
 
@@ -122,12 +238,30 @@ class XiaDaemon(ProjectBase):
                 raise IOError('output directory already exists...')
             # if we allow overwrite, just continue...
 
+        return rawdir, outdir
+
+
+    @property
+    def xia2_params(self):
         # format xia2 parameters as: param1=X param2=Y ...
         if self.xia2_config:
             xp_list = ['{}={}'.format(k,v) for (k,v) in self.xia2_config.items()]
-            xia2_params = ' '.join(xp_list)
+            return ' '.join(xp_list)
         else:
-            xia2_params = ''
+            return ''
+
+
+    def write_script(self, metadata, run, allow_overwrite=True):
+        """
+        Write the SLURM script for one dataset, return its path
+        """
+
+        # first, create the directory sub-structure
+        rawdir, outdir = self._make_outdir(metadata, run, allow_overwrite)
+
+        # cores, memory & walltime learnt from past jobs, if enabled
+        resources = self.job_resources('{}_'.format(self.name), metadata, run)
+        nproc, header = self.resource_request(resources, nproc=32)
 
         # then write and sub the slurm script
         batch_script="""#!/bin/bash
@@ -135,6 +269,7 @@ class XiaDaemon(ProjectBase):
 #SBATCH --partition={partition}
 #SBATCH --reservation={rsrvtn}
 #SBATCH --nodes=1
+{resources}
 #SBATCH --chdir     {outdir}
 #SBATCH --job-name  {name}_{metadata}-{run}
 #SBATCH --output    {name}_{metadata}-{run}.out
@@ -146,17 +281,19 @@ source /etc/profile.d/modules.sh
 module load ccp4/7.0
 
 imgs={rawdir}
-xia2 project=SARSCOV2 crystal={metadata}_{run:03d} nproc=32 {x2prms} $imgs
+xia2 project=SARSCOV2 crystal={metadata}_{run:03d} nproc={nproc} {x2prms} $imgs
 
         """.format(
                     name      = self.name,
+                    resources = header,
+                    nproc     = nproc,
                     metadata  = metadata,
                     run       = run,
                     partition = self.slurm_config.get('partition', 'all'),
                     rsrvtn    = self.slurm_config.get('reservation', ''),
                     rawdir    = rawdir,
                     outdir    = outdir,
-                    x2prms    = xia2_params,
+                    x2prms    = self.xia2_params,
                   )
 
         # create a slurm sub script
@@ -164,18 +301,92 @@ xia2 project=SARSCOV2 crystal={metadata}_{run:03d} nproc=32 {x2prms} $imgs
         with open(slurm_file, 'w') as f:
             f.write(batch_script)
 
+        return slurm_file
+
+
+    def submit_run(self, metadata, run, debug=False, allow_overwrite=True):
+
+        slurm_file = self.write_script(metadata, run, allow_overwrite=allow_overwrite)
+
         # submit to queue and cleanup
         if not debug:
-            r = subprocess.run("/usr/bin/sbatch {}".format(slurm_file), 
+            r = subprocess.run("/usr/bin/sbatch --parsable {}".format(slurm_file), 
                                shell=True, 
                                check=True,
-                               stdout=subprocess.DEVNULL, 
+                               stdout=subprocess.PIPE, 
                                stderr=subprocess.DEVNULL)
             os.remove(slurm_file)
 
+            if self.refinement is not None:
+                job_id = r.stdout.decode('utf-8').strip().split(';')[0]
+                self.chain_refinement({(metadata, run) : job_id})
+
         return
 
 
+    def submit_batch(self, mds, debug=False, allow_overwrite=True):
+        """
+        Submit many (metadata, run) as a SLURM job array, see submit_array
+        """
+
+        def make_row(metadata, run):
+            rawdir, outdir = self._make_outdir(metadata, run, allow_overwrite)
+            return {'metadata' : metadata, 'run' : run,
+                    'outdir' : outdir, 'rawdir' : rawdir}
+
+        rows, failed = self.prepare_jobs(mds, make_row)
+        rows = [ row for md, row in rows ]
+
+        def make_script(manifest):
+
+            # all tasks share one request, large enough for each of them
+            resources = largest([ self.job_resources('{}_'.format(self.name),
+                                                     row['metadata'], int(row['run']))
+                                  for row in read_manifest(manifest) ])
+            nproc, header = self.resource_request(resources, nproc=32)
+
+            return """#!/bin/bash
+
+#SBATCH --partition={partition}
+#SBATCH --reservation={rsrvtn}
+#SBATCH --nodes=1
+{resources}
+#SBATCH --job-name  {name}_{array}
+#SBATCH --output    {array_dir}/{name}_{array}-%A_%a.out
+
+row=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {manifest})
+metadata=$(echo "$row" | cut -f1)
+run=$(echo "$row" | cut -f2)
+outdir=$(echo "$row" | cut -f3)
+rawdir=$(echo "$row" | cut -f4)
+
+cd $outdir
+exec > {name}_${{metadata}}-${{run}}.out 2> {name}_${{metadata}}-${{run}}.err
+
+export LD_PRELOAD=""
+source /etc/profile.d/modules.sh
+
+module load ccp4/7.0
+
+imgs=$rawdir
+xia2 project=SARSCOV2 crystal=${{metadata}}_$(printf '%03d' $run) nproc={nproc} {x2prms} $imgs
+
+            """.format(
+                        name      = self.name,
+                        resources = header,
+                        nproc     = nproc,
+                        array     = ARRAY_NAME,
+                        array_dir = self.array_dir,
+                        manifest  = manifest,
+                        partition = self.slurm_config.get('partition', 'all'),
+                        rsrvtn    = self.slurm_config.get('reservation', ''),
+                        x2prms    = self.xia2_params,
+                      )
+
+        return self.submit_array('{}_'.format(self.name), rows, make_script,
+                                 debug=debug, failed=failed)
+
+
 def script():
 
     parser = argparse.ArgumentParser(description='Submit new reduction jobs.')
@@ -183,10 +394,35 @@ def script():
                         help='the configuration yaml file to use')
     parser.add_argument('--limit', type=int, default=None,
                         help='max number of jobs to submit')
+    parser.add_argument('--full-scan', action='store_true',
+                        help='check every dataset and report counts, even with --limit')
+    args = parser.parse_args()
+
+    xd = XiaDaemon.load_config(args.config)
+    xd.submit_unfinished(verbose=True, limit=args.limit, full_scan=args.full_scan)
+
+    return
+
+
+def recheck_script():
+
+    parser = argparse.ArgumentParser(description='Forget that raw data could not be '
+                                                 'found, so it is searched for again '
+                                                 'on the next reduction cycle.')
+    parser.add_argument('config', type=str,
+                        help='the configuration yaml file to use')
+    parser.add_argument('metadata', type=str, nargs='?', default=None,
+                        help='only this metadata (default: all)')
+    parser.add_argument('run', type=int, nargs='?', default=None,
+                        help='only this run of `metadata`')
     args = parser.parse_args()
 
     xd = XiaDaemon.load_config(args.config)
-    xd.submit_unfinished(verbose=True, limit=args.limit)
+    if xd.state_store is None:
+        raise RuntimeError('project.state_store is switched off, nothing to forget')
+
+    n = xd.state_store.clear_missing(args.metadata, args.run)
+    print('cleared {} missing-data entries'.format(n))
 
     return
 